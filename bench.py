@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Benchmarks of state checking and report generation of ci.py.
+
+Each benchmark runs in a forked process against a synthetic host, and
+records the best time of its operation and how much the operation
+raised the peak memory of the process over that of its setup. Results
+can be saved as a baseline and later runs compared against it.
+"""
+import os
+import sys
+import json
+import time
+import optparse
+import resource
+import tempfile
+
+import ci
+
+
+def _synthetic_host(**kwargs):
+    host = ci.SyntheticHost(**kwargs)
+    ci.install_command_backend(host)
+    return host
+
+
+def bench_domain_check(scale):
+    """
+    Check DomainState of a host with many domains having large XML,
+    a few of which were changed.
+    """
+    domains = int(10000 * scale)
+    host = _synthetic_host(domains=domains, networks=0, pools=0,
+                           secrets=0, xml_lines=300)
+    state = ci.DomainState()
+    state.backup()
+    for idx in range(0, domains, 100):
+        dom = host.domains['vm%d' % idx]
+        dom['xml'] = dom['xml'][:150] + ['<!-- changed -->'] + dom['xml'][150:]
+    host.domains['vm1']['state'] = 'running'
+    return lambda: state.check(recover=False)
+
+
+def bench_pool_check(scale):
+    """
+    Check PoolState of pools with thousands of volumes, with changes
+    only allowed by permit rules, plus a few created volumes.
+    """
+    host = _synthetic_host(domains=0, networks=0, pools=10,
+                           volumes=int(5000 * scale), secrets=0)
+    state = ci.PoolState()
+    state.backup()
+    for pool in host.pools.values():
+        pool['volumes'].append('created.img')
+    return lambda: state.check(recover=False)
+
+
+def bench_report_update(scale):
+    """
+    Add results of failed tests with multi-MB logs to a report.
+    """
+    log = ('2014-01-01 00:00:00 DEBUG| some debug output line\n' *
+           int(80000 * scale))
+    error_msg = ['  ERROR| line %d' % idx for idx in range(100)]
+
+    def update():
+        report = ci.Report()
+        for idx in range(10):
+            report.update('test%d' % idx, 'bench', 'FAIL', log, error_msg,
+                          1.0)
+    return update
+
+
+def bench_report_save(scale):
+    """
+    Save a report with many test cases.
+    """
+    report = ci.Report()
+    for idx in range(int(10000 * scale)):
+        report.update('test%d' % idx, 'bench%d' % (idx % 100),
+                      'FAIL' if idx % 10 else 'PASS',
+                      'output line\n' * 20, ['  ERROR| failure'], 1.0)
+    fd, fname = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+
+    def save():
+        try:
+            report.save(fname)
+        finally:
+            os.remove(fname)
+    return save
+
+
+BENCHMARKS = [
+    ('domain_check', bench_domain_check),
+    ('pool_check', bench_pool_check),
+    ('report_update', bench_report_update),
+    ('report_save', bench_report_save),
+]
+
+
+def run_benchmark(func, scale, repeat):
+    """
+    Run a benchmark in a forked process.
+
+    :return: A dict with best time in seconds and peak memory in MB
+             added by the operation.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            op = func(scale)
+            # ru_maxrss only grows, so the setup peak is the base.
+            base_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            times = []
+            for _ in range(repeat):
+                start_time = time.time()
+                op()
+                times.append(time.time() - start_time)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result = {'time': min(times),
+                      'op_peak_mb': (peak - base_peak) / 1024.0}
+        except Exception, e:
+            result = {'error': str(e)}
+        os.write(write_fd, json.dumps(result))
+        os._exit(0)
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def main():
+    parser = optparse.OptionParser(
+        description='Benchmark state checking and report generation.')
+    parser.add_option('--only', dest='only', action='store', default='',
+                      help='Run only specified benchmarks, separated '
+                      'by ","')
+    parser.add_option('--scale', dest='scale', action='store', default='1',
+                      help='Scale workload sizes, e.g. 0.1 for a quick run')
+    parser.add_option('--repeat', dest='repeat', action='store',
+                      default='3', help='Times to repeat each operation')
+    parser.add_option('--save-baseline', dest='save_baseline',
+                      action='store', default='',
+                      help='Save results to a baseline file')
+    parser.add_option('--baseline', dest='baseline', action='store',
+                      default='', help='Compare results against a '
+                      'baseline file')
+    parser.add_option('--threshold', dest='threshold', action='store',
+                      default='0.2', help='Allowed slowdown ratio against '
+                      'baseline before failing')
+    args, _ = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    onlys = set(args.only.split(',')) if args.only else None
+
+    results = {}
+    regressions = []
+    print '%-16s %10s %10s %10s %8s' % ('Benchmark', 'Time(s)', 'OpPeak(MB)',
+                                        'Base(s)', 'Change')
+    for name, func in BENCHMARKS:
+        if onlys is not None and name not in onlys:
+            continue
+        result = run_benchmark(func, float(args.scale), int(args.repeat))
+        results[name] = result
+        if 'error' in result:
+            print '%-16s ERROR: %s' % (name, result['error'])
+            regressions.append(name)
+            continue
+        line = '%-16s %10.3f %10.1f' % (name, result['time'],
+                                        result['op_peak_mb'])
+        if name in baseline:
+            base_time = baseline[name]['time']
+            change = result['time'] / base_time - 1 if base_time else 0
+            line += ' %10.3f %+7.1f%%' % (base_time, change * 100)
+            if change > float(args.threshold):
+                regressions.append(name)
+        print line
+        sys.stdout.flush()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fp:
+            json.dump(results, fp, indent=1)
+    if regressions:
+        print 'Regressed: %s' % ', '.join(regressions)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vi:set ts=4 sw=4 expandtab:
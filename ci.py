@@ -6,18 +6,33 @@ import time
 import urllib
 import urllib2
 import json
+import hashlib
 import shutil
+import stat
 import string
 import difflib
 import logging
 import optparse
+import pipes
 import tempfile
-import fileinput
+import contextlib
+import csv
+import fcntl
+import glob
+import gzip
+import tarfile
+import threading
+import subprocess
+import socket
+import Queue
 import traceback
+import zlib
+import signal
 from virttest import common
 from virttest import utils_libvirtd, utils_selinux
 from virttest import data_dir
 from virttest import virsh
+from virttest import remote
 from virttest.staging import service
 from autotest.client import utils
 from virttest.utils_misc import mount, umount
@@ -126,25 +141,68 @@ class Report():
         for ts_name in self.ts_dict:
             ts = self.ts_dict[ts_name]
             testsuites.add_testsuite(ts)
-        with open(filename, 'w') as fp:
+        tmp_name = filename + '.tmp'
+        with open(tmp_name, 'w') as fp:
             testsuites.export(fp, 0)
+        os.rename(tmp_name, filename)
+
+    @staticmethod
+    def escape_str(inStr):
+        """
+        Escape a string for HTML use.
+        """
+        s1 = (isinstance(inStr, basestring) and inStr or
+              '%s' % inStr)
+        s1 = s1.replace('&', '&amp;')
+        s1 = s1.replace('<', '&lt;')
+        s1 = s1.replace('>', '&gt;')
+        s1 = s1.replace('"', "&quot;")
+        return s1
+
+    @staticmethod
+    def printable_str(inStr):
+        """
+        Filter non-printable characters in a string.
+        """
+        return ''.join(s for s in unicode(inStr, errors='ignore')
+                       if s in string.printable)
+
+    def find_testcase(self, testname, ts_name):
+        ts = self.ts_dict.get(ts_name)
+        if ts is None:
+            return None, None
+        for tc in reversed(ts.testcase):
+            if tc.name == testname:
+                return ts, tc
+        return ts, None
+
+    def add_diff(self, testname, ts_name, diff_msg):
+        """
+        Attribute state changes found after a test was reported to it.
+        """
+        ts, tc = self.find_testcase(testname, ts_name)
+        if tc is None:
+            return
+        lines = [self.escape_str(self.printable_str(line))
+                 for line in diff_msg]
+        result = tc.failure or tc.error or tc.skip
+        if result is not None:
+            result.message = '&#10;'.join([result.message] + lines)
+        elif self.fail_diff:
+            lines.insert(0, 'Test %s results dirty environment' % testname)
+            tc.failure = self.failureType(
+                message='&#10;'.join(lines),
+                type_='DIFF')
+            ts.failures += 1
+        else:
+            tc.system_err = '\n'.join(
+                [tc.system_err or ''] +
+                [self.printable_str(line) for line in diff_msg])
 
     def update(self, testname, ts_name, result, log, error_msg, duration):
         """
         Insert a new item into report.
         """
-        def escape_str(inStr):
-            """
-            Escape a string for HTML use.
-            """
-            s1 = (isinstance(inStr, basestring) and inStr or
-                  '%s' % inStr)
-            s1 = s1.replace('&', '&amp;')
-            s1 = s1.replace('<', '&lt;')
-            s1 = s1.replace('>', '&gt;')
-            s1 = s1.replace('"', "&quot;")
-            return s1
-
         if ts_name not in self.ts_dict:
             self.ts_dict[ts_name] = self.testsuite(name=ts_name)
             ts = self.ts_dict[ts_name]
@@ -159,17 +217,11 @@ class Report():
         tc.name = testname
         tc.time = duration
 
-        # Filter non-printable characters in log
-        log = ''.join(s for s in unicode(log, errors='ignore')
-                      if s in string.printable)
-        tc.system_out = log
+        tc.system_out = self.printable_str(log)
 
         tmp_msg = []
         for line in error_msg:
-            # Filter non-printable characters in error message
-            line = ''.join(s for s in unicode(line, errors='ignore')
-                           if s in string.printable)
-            tmp_msg.append(escape_str(line))
+            tmp_msg.append(self.escape_str(self.printable_str(line)))
         error_msg = tmp_msg
 
 
@@ -211,6 +263,47 @@ class Report():
 class State():
     permit_keys = []
     permit_re = []
+    # States are recovered from lower to higher level, and removed
+    # from higher to lower level.
+    recover_level = 0
+    # Expensive states may be checked once for several tests.
+    expensive = False
+    # Whether the backup can be stored and reused by later runs.
+    persistent = True
+
+    def __init__(self, uri=None):
+        self.uri = uri or None
+        self.window = []
+        self.window_time = 0.0
+        self.cost = 0.0
+
+    def sample(self, test, duration, every=1, budget=None):
+        """
+        Add a finished test to the window of unchecked tests.
+
+        Return True when the state should be checked now, which is
+        always for cheap states. Expensive states are checked every
+        _every_ tests, or when checking costs less than _budget_ times
+        the run time of tests in the window.
+        """
+        self.window.append(test)
+        self.window_time += duration
+        if not self.expensive:
+            return True
+        if budget is not None:
+            return self.cost <= budget * self.window_time
+        return len(self.window) >= every
+
+    def timed_check(self, recover=False, planner=None):
+        """
+        Check the state, record check cost and clear the test window.
+        """
+        start_time = time.time()
+        diff_msg = self.check(recover=recover, planner=planner)
+        self.cost = time.time() - start_time
+        self.window = []
+        self.window_time = 0.0
+        return diff_msg
 
     def get_names(self):
         raise NotImplementedError('Function get_names not implemented for %s.'
@@ -241,10 +334,49 @@ class State():
         """
         self.backup_state = self.get_state()
 
-    def check(self, recover=False):
+    def cleanup(self):
+        """
+        Remove anything kept for restoring the backup.
+        """
+        pass
+
+    def dump(self):
+        """
+        Return the backup as data to be stored, which load() takes.
+        """
+        return {'backup': self.backup_state}
+
+    def load(self, data):
+        """
+        Take a backup stored by dump(), maybe in an earlier run.
+        """
+        self.backup_state = data['backup']
+
+    def snapshot(self):
+        """
+        Return the current state for revert().
+        """
+        return self.get_state()
+
+    def revert(self, snapshot):
+        """
+        Recover changes made since _snapshot_ was taken, keeping the
+        backup.
+        """
+        backup_state = self.backup_state
+        self.backup_state = snapshot
+        try:
+            return self.check(recover=True)
+        finally:
+            self.backup_state = backup_state
+
+    def check(self, recover=False, planner=None):
         """
         Check state changes and recover to specified state.
         Return a result.
+
+        When a RecoveryPlanner is given, recover actions are added to it
+        instead of being run here.
         """
         def diff_dict(dict_old, dict_new):
             created = set(dict_new) - set(dict_old)
@@ -273,29 +405,20 @@ class State():
 
         self.current_state = self.get_state()
         diff_msg = []
+        actions = []
         new_items, del_items, unchanged_items = diff_dict(
             self.backup_state, self.current_state)
         if new_items:
             diff_msg.append('Created %s(s):' % self.name)
             for item in new_items:
                 diff_msg.append(item)
-                if recover:
-                    try:
-                        self.remove(self.current_state[item])
-                    except Exception, e:
-                        traceback.print_exc()
-                        diff_msg.append('Remove is failed:\n %s' % e)
+                actions.append(('Remove', self.current_state[item]))
 
         if del_items:
             diff_msg.append('Deleted %s(s):' % self.name)
             for item in del_items:
                 diff_msg.append(item)
-                if recover:
-                    try:
-                        self.restore(self.backup_state[item])
-                    except Exception, e:
-                        traceback.print_exc()
-                        diff_msg.append('Recover is failed:\n %s' % e)
+                actions.append(('Recover', self.backup_state[item]))
 
         for item in unchanged_items:
             cur = self.current_state[item]
@@ -322,6 +445,15 @@ class State():
                         item_changed = True
                         diff_msg.append('%s %s: %s changed: %s -> %s' % (
                             self.name, item, key, bak[key], cur[key]))
+                elif type(cur[key]) is set:
+                    created = sorted(cur[key] - bak[key])
+                    deleted = sorted(bak[key] - cur[key])
+                    if created or deleted:
+                        item_changed = True
+                        diff_msg.append('%s %s: "%s" changed:' %
+                                        (self.name, item, key))
+                        diff_msg += ['+%s' % line for line in created]
+                        diff_msg += ['-%s' % line for line in deleted]
                 elif type(cur[key]) is list:
                     diff = difflib.unified_diff(
                         bak[key], cur[key], lineterm="")
@@ -337,29 +469,45 @@ class State():
                 else:
                     diff_msg.append('%s %s: %s: Invalid type %s.' % (
                         self.name, item, key, type(cur[key])))
-            if item_changed and recover:
+            if item_changed:
+                actions.append(('Recover', self.backup_state[item]))
+
+        if recover:
+            for action, info in actions:
+                if planner is not None:
+                    planner.add(self, action, info)
+                    continue
                 try:
-                    self.restore(self.backup_state[item])
+                    self.recover_item(action, info)
                 except Exception, e:
                     traceback.print_exc()
-                    diff_msg.append('Recover is failed:\n %s' % e)
+                    diff_msg.append('%s is failed:\n %s' % (action, e))
         return diff_msg
 
+    def recover_item(self, action, info):
+        if action == 'Remove':
+            self.remove(info)
+        else:
+            self.restore(info)
+
 
 class DomainState(State):
     name = 'domain'
+    recover_level = 3
+    expensive = True
     permit_keys = ['id', 'cpu time', 'security label']
 
     def remove(self, name):
         dom = name
         if dom['state'] != 'shut off':
-            res = virsh.destroy(dom['name'])
+            res = virsh.destroy(dom['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
         if dom['persistent'] == 'yes':
             # Make sure the domain is remove anyway
             res = virsh.undefine(
-                dom['name'], options='--snapshots-metadata --managed-save')
+                dom['name'], options='--snapshots-metadata --managed-save',
+                uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
@@ -377,40 +525,59 @@ class DomainState(State):
 
         try:
             if dom['persistent'] == 'yes':
-                res = virsh.define(fname)
+                res = virsh.define(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
                 if dom['state'] != 'shut off':
-                    res = virsh.start(name)
+                    res = virsh.start(name, uri=self.uri)
                     if res.exit_status:
                         raise Exception(str(res))
             else:
-                res = virsh.create(fname)
+                res = virsh.create(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
         finally:
             os.remove(fname)
 
         if dom['autostart'] == 'enable':
-            res = virsh.autostart(name, '')
+            res = virsh.autostart(name, '', uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
     def get_info(self, name):
         infos = {}
-        for line in virsh.dominfo(name).stdout.strip().splitlines():
+        res = virsh.dominfo(name, uri=self.uri)
+        for line in res.stdout.strip().splitlines():
             key, value = line.split(':', 1)
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.dumpxml(
-            name, extra='--inactive').stdout.splitlines()
+            name, extra='--inactive', uri=self.uri).stdout.splitlines()
         return infos
 
+    def digest(self, name):
+        """
+        Return a digest of the inactive XML of a domain from the last
+        check, or None when it may have changed since or differs from
+        the backup, i.e. is being recovered.
+        """
+        if self.window or not hasattr(self, 'current_state'):
+            return None
+        cur = self.current_state.get(name)
+        bak = self.backup_state.get(name)
+        if cur is None or bak is None:
+            return None
+        if cur['inactive xml'] != bak['inactive xml']:
+            return None
+        return hashlib.sha1('\n'.join(cur['inactive xml'])).hexdigest()
+
     def get_names(self):
-        return virsh.dom_list(options='--all --name').stdout.splitlines()
+        return virsh.dom_list(options='--all --name',
+                              uri=self.uri).stdout.splitlines()
 
 
 class NetworkState(State):
     name = 'network'
+    recover_level = 2
 
     def remove(self, name):
         """
@@ -420,11 +587,11 @@ class NetworkState(State):
         """
         net = name
         if net['active'] == 'yes':
-            res = virsh.net_destroy(net['name'])
+            res = virsh.net_destroy(net['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
         if net['persistent'] == 'yes':
-            res = virsh.net_undefine(net['name'])
+            res = virsh.net_undefine(net['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
@@ -448,47 +615,64 @@ class NetworkState(State):
 
         try:
             if net['persistent'] == 'yes':
-                res = virsh.net_define(fname)
+                res = virsh.net_define(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
                 if net['active'] == 'yes':
-                    res = virsh.net_start(name)
+                    res = virsh.net_start(name, uri=self.uri)
                     if res.exit_status:
-                        res = virsh.net_start(name)
+                        res = virsh.net_start(name, uri=self.uri)
                         if res.exit_status:
                             raise Exception(str(res))
             else:
-                res = virsh.net_create(fname)
+                res = virsh.net_create(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
         finally:
             os.remove(fname)
 
         if net['autostart'] == 'yes':
-            res = virsh.net_autostart(name)
+            res = virsh.net_autostart(name, uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
     def get_info(self, name):
         infos = {}
-        for line in virsh.net_info(name).stdout.strip().splitlines():
+        res = virsh.net_info(name, uri=self.uri)
+        for line in res.stdout.strip().splitlines():
             key, value = line.split()
             if key.endswith(':'):
                 key = key[:-1]
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.net_dumpxml(
-            name, '--inactive').stdout.splitlines()
+            name, '--inactive', uri=self.uri).stdout.splitlines()
         return infos
 
     def get_names(self):
-        lines = virsh.net_list('--all').stdout.strip().splitlines()[2:]
+        res = virsh.net_list('--all', uri=self.uri)
+        lines = res.stdout.strip().splitlines()[2:]
         return [line.split()[0] for line in lines]
 
 
 class PoolState(State):
+
+    """
+    Storage pools with their volumes.
+
+    Volumes of running directory backed pools on the local host are
+    only listed again when the mtime of the directory changed.
+    """
     name = 'pool'
+    recover_level = 2
+    expensive = True
     permit_keys = ['available', 'allocation']
     permit_re = [r'^[-+]\s*\<(capacity|allocation|available).*$']
+    dir_types = ['dir', 'fs', 'netfs']
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        # Pool name -> (fingerprint, list time, volumes)
+        self.volumes = {}
 
     def remove(self, name):
         """
@@ -498,11 +682,11 @@ class PoolState(State):
         """
         pool = name
         if pool['state'] == 'running':
-            res = virsh.pool_destroy(pool['name'])
+            res = virsh.pool_destroy(pool['name'], uri=self.uri)
             if not res:
                 raise Exception(str(res))
         if pool['persistent'] == 'yes':
-            res = virsh.pool_undefine(pool['name'])
+            res = virsh.pool_undefine(pool['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
@@ -520,15 +704,15 @@ class PoolState(State):
 
         try:
             if pool['persistent'] == 'yes':
-                res = virsh.pool_define(fname)
+                res = virsh.pool_define(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
                 if pool['state'] == 'running':
-                    res = virsh.pool_start(name)
+                    res = virsh.pool_start(name, uri=self.uri)
                     if res.exit_status:
                         raise Exception(str(res))
             else:
-                res = virsh.pool_create(fname)
+                res = virsh.pool_create(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
         except Exception, e:
@@ -537,51 +721,93 @@ class PoolState(State):
             os.remove(fname)
 
         if pool['autostart'] == 'yes':
-            res = virsh.pool_autostart(name)
+            res = virsh.pool_autostart(name, uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
     def get_info(self, name):
         infos = {}
-        for line in virsh.pool_info(name).stdout.strip().splitlines():
+        res = virsh.pool_info(name, uri=self.uri)
+        for line in res.stdout.strip().splitlines():
             key, value = line.split(':', 1)
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.pool_dumpxml(
-            name, '--inactive').splitlines()
-        infos['volumes'] = virsh.vol_list(name).stdout.strip().splitlines()[2:]
+            name, '--inactive', uri=self.uri).splitlines()
+        infos['volumes'] = self.get_volumes(name, infos)
         return infos
 
+    def get_fingerprint(self, infos):
+        """
+        Return the target path and its mtime for a running directory
+        backed pool on the local host, or None.
+        """
+        if infos.get('state') != 'running':
+            return None
+        if self.uri and not re.match(r'^[\w+]+:///', self.uri):
+            return None
+        xml = '\n'.join(infos['inactive xml'])
+        match = re.search(r'<pool type=[\'"](\w+)[\'"]', xml)
+        if not match or match.group(1) not in self.dir_types:
+            return None
+        match = re.search(r'<target>\s*<path>(.*?)</path>', xml, re.S)
+        if not match:
+            return None
+        try:
+            return match.group(1), os.stat(match.group(1)).st_mtime
+        except OSError:
+            return None
+
+    def get_volumes(self, name, infos):
+        """
+        Get volumes of a pool as a set of 'name path' strings.
+        """
+        fingerprint = self.get_fingerprint(infos)
+        cached = self.volumes.get(name)
+        # A change in the same second as the last listing could keep
+        # the mtime.
+        if (fingerprint is not None and cached is not None and
+                cached[0] == fingerprint and fingerprint[1] < cached[1] - 1):
+            return set(cached[2])
+        list_time = time.time()
+        res = virsh.vol_list(name, uri=self.uri)
+        volumes = set(' '.join(line.split())
+                      for line in res.stdout.strip().splitlines()[2:])
+        self.volumes[name] = (fingerprint, list_time, volumes)
+        return set(volumes)
+
     def get_names(self):
-        lines = virsh.pool_list('--all').stdout.strip().splitlines()[2:]
+        res = virsh.pool_list('--all', uri=self.uri)
+        lines = res.stdout.strip().splitlines()[2:]
         return [line.split()[0] for line in lines]
 
 
 class SecretState(State):
     name = 'secret'
+    recover_level = 2
     permit_keys = []
     permit_re = []
 
     def remove(self, name):
         secret = name
-        res = virsh.secret_undefine(secret['uuid'])
+        res = virsh.secret_undefine(secret['uuid'], uri=self.uri)
         if res.exit_status:
             raise Exception(str(res))
 
     def restore(self, name):
-        uuid = name
+        uuid = name['uuid']
         cur = self.current_state
         bak = self.backup_state
 
         if uuid in cur:
-            self.remove(name)
+            self.remove(cur[uuid])
 
         secret_file = tempfile.NamedTemporaryFile(delete=False)
         fname = secret_file.name
-        secret_file.writelines(bak[name]['xml'])
+        secret_file.writelines(bak[uuid]['xml'])
         secret_file.close()
 
         try:
-            res = virsh.secret_define(fname)
+            res = virsh.secret_define(fname, uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
         except Exception, e:
@@ -592,19 +818,24 @@ class SecretState(State):
     def get_info(self, name):
         infos = {}
         infos['uuid'] = name
-        infos['xml'] = virsh.secret_dumpxml(name).stdout.splitlines()
+        infos['xml'] = virsh.secret_dumpxml(
+            name, uri=self.uri).stdout.splitlines()
         return infos
 
     def get_names(self):
-        lines = virsh.secret_list().stdout.strip().splitlines()[2:]
+        lines = virsh.secret_list(uri=self.uri).stdout.strip().splitlines()[2:]
         return [line.split()[0] for line in lines]
 
 
 class MountState(State):
     name = 'mount'
+    recover_level = 1
     permit_keys = []
     permit_re = []
-    info = {}
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        self.infos = {}
 
     def remove(self, name):
         info = name
@@ -621,35 +852,397 @@ class MountState(State):
             raise Exception("Failed to mount %s" % info['mount_point'])
 
     def get_info(self, name):
-        return self.info[name]
+        return self.infos[name]
 
     def get_names(self):
         """
-        Get all mount infomations from /etc/mtab.
+        Get all mount infomations from /proc/self/mountinfo.
 
-        :return: A dict using mount point as keys and 6-element dict as value.
+        :return: A list of mount points.
         """
-        lines = file('/etc/mtab').read().splitlines()
-        names = []
-        for line in lines:
-            values = line.split()
-            if len(values) != 6:
-                print 'Warning: Error parsing mountpoint: %s' % line
+        def unescape(value):
+            return re.sub(r'\\([0-7]{3})',
+                          lambda m: chr(int(m.group(1), 8)), value)
+
+        self.infos = {}
+        with open('/proc/self/mountinfo') as fp:
+            for line in fp:
+                values = line.split()
+                if '-' not in values[6:]:
+                    print 'Warning: Error parsing mountpoint: %s' % line
+                    continue
+                sep = values.index('-', 6)
+                mount_point = unescape(values[4])
+                self.infos[mount_point] = {
+                    'src': unescape(values[sep + 2]),
+                    'mount_point': mount_point,
+                    'fstype': values[sep + 1],
+                    'options': values[5],
+                }
+        return self.infos.keys()
+
+
+class LinkState(State):
+
+    """
+    Network links, with bridges, tun and tap devices they are attached
+    to, read from /sys/class/net. Links libvirt creates for domain
+    interfaces and bridges of active libvirt networks come and go with
+    them, and are left to DomainState and NetworkState.
+    """
+    name = 'link'
+    # After networks and domains, which bring their own links with them.
+    recover_level = 3
+    permit_keys = []
+    permit_re = []
+    # Names libvirt generates for domain interfaces, and refuses as
+    # user supplied target devices.
+    domain_link_re = re.compile(r'^(vnet|macvtap|macvlan)\d+$')
+    # Status of active networks of the system libvirtd and of private
+    # instances.
+    network_status = ['/var/run/libvirt/network/*.xml',
+                      '/var/run/virt-test-ci/*/var_run_libvirt/network/*.xml']
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        self.infos = {}
+
+    def get_kind(self, path):
+        if os.path.isdir(os.path.join(path, 'bridge')):
+            return 'bridge'
+        try:
+            with open(os.path.join(path, 'tun_flags')) as fp:
+                # IFF_TAP
+                return 'tap' if int(fp.read(), 16) & 0x0002 else 'tun'
+        except IOError:
+            pass
+        with open(os.path.join(path, 'uevent')) as fp:
+            for line in fp:
+                if line.startswith('DEVTYPE='):
+                    return line.strip().split('=', 1)[1]
+        if os.path.exists(os.path.join(path, 'device')):
+            return 'device'
+        return 'virtual'
+
+    def remove(self, name):
+        link = name['name']
+        if os.path.exists(os.path.join('/sys/class/net', link)):
+            utils.run('ip link delete %s' % link)
+
+    def restore(self, name):
+        link = name['name']
+        path = os.path.join('/sys/class/net', link)
+        if not os.path.exists(path):
+            if name['kind'] != 'bridge':
+                raise Exception('Can not restore %s link %s' %
+                                (name['kind'], link))
+            utils.run('ip link add name %s type bridge' % link)
+            utils.run('ip link set %s up' % link)
+        master = os.path.join(path, 'master')
+        cur_master = ''
+        if os.path.islink(master):
+            cur_master = os.path.basename(os.readlink(master))
+        if cur_master != name['master']:
+            if name['master']:
+                utils.run('ip link set %s master %s' % (link, name['master']))
+            else:
+                utils.run('ip link set %s nomaster' % link)
+
+    def get_info(self, name):
+        return self.infos[name]
+
+    def network_bridges(self):
+        bridges = set()
+        for pattern in self.network_status:
+            for path in glob.glob(pattern):
+                try:
+                    with open(path) as fp:
+                        match = re.search(r'<bridge\s[^>]*?name=[\'"](.*?)'
+                                          r'[\'"]', fp.read())
+                except IOError:
+                    continue
+                if match:
+                    bridges.add(match.group(1))
+        return bridges
+
+    def get_names(self):
+        self.infos = {}
+        network_bridges = self.network_bridges()
+        for link in os.listdir('/sys/class/net'):
+            if (self.domain_link_re.match(link) or
+                    link in network_bridges):
+                continue
+            path = os.path.join('/sys/class/net', link)
+            master = os.path.join(path, 'master')
+            try:
+                self.infos[link] = {
+                    'name': link,
+                    'kind': self.get_kind(path),
+                    'master': (os.path.basename(os.readlink(master))
+                               if os.path.islink(master) else ''),
+                }
+            except (IOError, OSError):
+                # Removed while reading it.
+                continue
+        return self.infos.keys()
+
+
+class LoopState(State):
+
+    """
+    Attached loop devices, read from /sys/block.
+    """
+    name = 'loop device'
+    recover_level = 0
+    permit_keys = []
+    permit_re = []
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        self.infos = {}
+
+    def remove(self, name):
+        utils.run('losetup -d %s' % name['device'])
+
+    def restore(self, name):
+        device = name['device']
+        if device in self.current_state:
+            self.remove(self.current_state[device])
+        cmd = 'losetup -o %s' % name['offset']
+        if name['sizelimit'] != '0':
+            cmd += ' --sizelimit %s' % name['sizelimit']
+        utils.run("%s %s '%s'" % (cmd, device, name['backing_file']))
+
+    def get_info(self, name):
+        return self.infos[name]
+
+    def get_names(self):
+        self.infos = {}
+        for dev in glob.glob('/sys/block/loop*/loop'):
+            info = {'device': '/dev/' + dev.split('/')[3]}
+            try:
+                for key in ['backing_file', 'offset', 'sizelimit',
+                            'autoclear']:
+                    with open(os.path.join(dev, key)) as fp:
+                        info[key] = fp.read().strip()
+            except IOError:
+                # Detached while reading it.
+                continue
+            self.infos[info['device']] = info
+        return self.infos.keys()
+
+
+class DeviceMapperState(State):
+
+    """
+    Device mapper targets, read from /sys/block. Their tables are only
+    read at backup, to restore removed targets.
+    """
+    name = 'device mapper'
+    recover_level = 0
+    permit_keys = []
+    permit_re = []
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        self.infos = {}
+        self.tables = {}
+
+    def backup(self):
+        State.backup(self)
+        self.tables = {}
+        if not self.backup_state:
+            return
+        res = utils.run('dmsetup table', ignore_status=True)
+        for line in res.stdout.splitlines():
+            name, _, table = line.partition(': ')
+            self.tables.setdefault(name, []).append(table)
+
+    def dump(self):
+        return {'backup': self.backup_state, 'tables': self.tables}
+
+    def load(self, data):
+        State.load(self, data)
+        self.tables = data['tables']
+
+    def remove(self, name):
+        utils.run('dmsetup remove %s' % name['name'])
+
+    def restore(self, name):
+        if name['name'] not in self.tables:
+            raise Exception('Table of device mapper target %s is unknown' %
+                            name['name'])
+        if name['name'] in self.current_state:
+            self.remove(self.current_state[name['name']])
+        table_file = tempfile.NamedTemporaryFile(delete=False)
+        fname = table_file.name
+        table_file.write('\n'.join(self.tables[name['name']]) + '\n')
+        table_file.close()
+        try:
+            cmd = 'dmsetup create %s' % name['name']
+            if name['uuid']:
+                cmd += ' --uuid %s' % name['uuid']
+            utils.run('%s %s' % (cmd, fname))
+        finally:
+            os.remove(fname)
+
+    def get_info(self, name):
+        return self.infos[name]
+
+    def get_names(self):
+        self.infos = {}
+        for dev in glob.glob('/sys/block/dm-*'):
+            try:
+                info = {}
+                for key in ['name', 'uuid']:
+                    with open(os.path.join(dev, 'dm', key)) as fp:
+                        info[key] = fp.read().strip()
+                info['slaves'] = ','.join(sorted(
+                    os.listdir(os.path.join(dev, 'slaves'))))
+            except (IOError, OSError):
+                # Removed while reading it.
+                continue
+            self.infos[info['name']] = info
+        return self.infos.keys()
+
+
+class FirewallState(State):
+
+    """
+    Firewall rules, with one iptables-save per address family for
+    legacy iptables tables, and one listing per nftables table.
+    iptables backed by nftables is only tracked in the nftables tables.
+    Only changed tables are restored, leaving the live rules of
+    firewalld and libvirt in other tables alone.
+    """
+    name = 'firewall'
+    # After networks, which bring their own rules with them.
+    recover_level = 3
+    permit_keys = []
+    permit_re = []
+    families = [('ipv4', 'iptables'), ('ipv6', 'ip6tables')]
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        self.infos = {}
+
+    def remove(self, name):
+        if name['command'] == 'nft':
+            utils.run('nft delete table %s %s' % (name['family'],
+                                                  name['table']))
+        else:
+            utils.run('%s -t %s -F && %s -t %s -X' % (
+                name['command'], name['table'],
+                name['command'], name['table']))
+
+    def restore(self, name):
+        rule_file = tempfile.NamedTemporaryFile(delete=False)
+        fname = rule_file.name
+        if name['command'] == 'nft':
+            # Create the table first so that deleting it can't fail, all
+            # in one transaction.
+            table = '%s %s' % (name['family'], name['table'])
+            rule_file.write('table %s\n' % table)
+            rule_file.write('delete table %s\n' % table)
+            rule_file.write('\n'.join(name['rules']) + '\n')
+            cmd = 'nft -f %s' % fname
+        else:
+            rule_file.write('*%s\n' % name['table'])
+            rule_file.write('\n'.join(name['rules']) + '\n')
+            rule_file.write('COMMIT\n')
+            cmd = '%s-restore < %s' % (name['command'], fname)
+        rule_file.close()
+        try:
+            utils.run(cmd)
+        finally:
+            os.remove(fname)
+
+    def get_info(self, name):
+        return self.infos[name]
+
+    def get_names(self):
+        self.infos = {}
+        for family, command in self.families:
+            res = utils.run('%s-save' % command, ignore_status=True)
+            if res.exit_status or 'nft' in res.stdout.split('\n', 1)[0]:
+                continue
+            info = None
+            for line in res.stdout.splitlines():
+                if line.startswith('*'):
+                    table = line[1:]
+                    info = {'name': '%s %s' % (family, table),
+                            'command': command, 'table': table,
+                            'rules': []}
+                elif line == 'COMMIT' and info is not None:
+                    self.infos[info['name']] = info
+                    info = None
+                elif info is not None and not line.startswith('#'):
+                    # Drop packet and byte counters of chains.
+                    info['rules'].append(re.sub(r' \[\d+:\d+\]$', '', line))
+        # Stateless listing, without counters.
+        res = utils.run('nft -s list ruleset', ignore_status=True)
+        if res.exit_status:
+            return self.infos.keys()
+        info = None
+        for line in res.stdout.splitlines():
+            if line.startswith('table '):
+                family, table = line.split()[1:3]
+                info = {'name': 'nftables %s %s' % (family, table),
+                        'command': 'nft', 'family': family, 'table': table,
+                        'rules': []}
+            if info is None:
                 continue
-            keys = ['src', 'mount_point', 'fstype', 'options', 'dump', 'order']
-            mount_entry = dict(zip(keys, values))
-            mount_point = mount_entry['mount_point']
-            names.append(mount_point)
-            self.info[mount_point] = mount_entry
-        return names
+            info['rules'].append(line)
+            if line == '}':
+                self.infos[info['name']] = info
+                info = None
+        return self.infos.keys()
+
+
+class ModuleState(State):
+
+    """
+    Loaded kernel modules, read from /proc/modules. Modules loaded by a
+    test may as well be loaded on demand by the kernel, so they are only
+    reported once and never unloaded.
+    """
+    name = 'kernel module'
+    recover_level = 0
+    permit_keys = []
+    permit_re = []
+
+    def remove(self, name):
+        # Take it into the backup so that it is reported only once.
+        self.backup_state[name['name']] = name
+
+    def restore(self, name):
+        utils.run('modprobe %s' % name['name'])
+
+    def get_info(self, name):
+        return {'name': name}
+
+    def get_names(self):
+        # Kernels without module support have no /proc/modules.
+        if not os.path.exists('/proc/modules'):
+            return []
+        with open('/proc/modules') as fp:
+            return [line.split(' ', 1)[0] for line in fp]
 
 
 class ServiceState(State):
     name = 'service'
     libvirtd = utils_libvirtd.Libvirtd()
+    services = ['libvirtd', 'selinux']
     permit_keys = []
     permit_re = []
 
+    def __init__(self, uri=None, libvirtd=None):
+        State.__init__(self, uri)
+        if libvirtd is not None:
+            # SELinux is host wide, leave it to the host ServiceState.
+            self.libvirtd = libvirtd
+            self.services = ['libvirtd']
+
     def remove(self, name):
         raise Exception('It is meaningless to remove service %s' % name)
 
@@ -680,41 +1273,202 @@ class ServiceState(State):
         return {'name': name, 'status': status}
 
     def get_names(self):
-        return ['libvirtd', 'selinux']
+        return list(self.services)
 
 
 class DirState(State):
+
+    """
+    Entries under some directories, recursively, with the size, mtime
+    and inode of files. Writes to guest images, which are kept between
+    tests, are not changes.
+
+    At backup, files are cloned into a hidden store in each directory,
+    so deleted or modified files can be restored without copying their
+    data. Where cloning isn't supported, small files are copied and
+    larger ones hard linked, which only keeps them from being deleted.
+    """
     name = 'directory'
+    recover_level = 1
+    expensive = True
+    # Stores are removed at the end of each run.
+    persistent = False
+    # Top level entries which may be deleted, and are not descended.
     permit_keys = ['aexpect']
     permit_re = []
+    store_name = '.virt-test-ci-store'
+    # Files only compared by name and type.
+    image_re = r'.*\.(qcow2|img|raw|iso)$'
+    # Largest file copied when it can't be cloned.
+    copy_limit = 64 * 1024 * 1024
+    # ioctl cloning a file on btrfs and xfs.
+    FICLONE = 0x40049409
+
+    def __init__(self, uri=None):
+        State.__init__(self, uri)
+        self.listings = {}
+
+    def store_path(self, dirname, rel_path):
+        return os.path.join(dirname, self.store_name, rel_path)
+
+    def clone_file(self, src, dst):
+        """
+        Make dst a copy of src, sharing its data when possible. Return
+        'clone' for a copy on write clone, 'copy' for a copy, or 'link'
+        for a hard link.
+        """
+        try:
+            with open(src) as src_fp:
+                with open(dst, 'w') as dst_fp:
+                    fcntl.ioctl(dst_fp.fileno(), self.FICLONE,
+                                src_fp.fileno())
+            shutil.copystat(src, dst)
+            return 'clone'
+        except (IOError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+        if os.path.getsize(src) <= self.copy_limit:
+            shutil.copy2(src, dst)
+            return 'copy'
+        os.link(src, dst)
+        return 'link'
+
+    def backup(self):
+        # Stores left by a run which was killed.
+        self.cleanup()
+        State.backup(self)
+        for dirname, infos in self.backup_state.items():
+            store = os.path.join(dirname, self.store_name)
+            if os.path.exists(store):
+                shutil.rmtree(store)
+            os.mkdir(store)
+            for rel_path in sorted(infos):
+                if rel_path == 'dir-name':
+                    continue
+                stored = self.store_path(dirname, rel_path)
+                info = infos[rel_path]
+                try:
+                    if info.startswith('dir'):
+                        os.makedirs(stored)
+                    elif info.startswith('file'):
+                        self.clone_file(os.path.join(dirname, rel_path),
+                                        stored)
+                except (IOError, OSError), e:
+                    logging.warning('Failed to store %s in %s: %s',
+                                    rel_path, store, e)
+
+    def cleanup(self):
+        for dirname in set(self.get_names()) | set(
+                getattr(self, 'backup_state', {})):
+            shutil.rmtree(os.path.join(dirname, self.store_name),
+                          ignore_errors=True)
 
     def remove(self, name):
         raise Exception('It is not wise to remove a dir %s' % name)
 
     def restore(self, name):
+        """
+        Remove created entries, and restore deleted or changed ones.
+        Modified files are restored from the store unless it only holds
+        a hard link to them.
+        """
         dirname = name['dir-name']
         cur = self.current_state[dirname]
         bak = self.backup_state[dirname]
-        created_files = set(cur) - set(bak)
-        if created_files:
-            for fname in created_files:
-                fpath = os.path.join(name['dir-name'], fname)
-                if os.path.isfile(fpath):
-                    os.remove(fpath)
-                elif os.path.isdir(fpath):
-                    shutil.rmtree(fpath)
-        deleted_files = set(bak) - set(cur)
-        if deleted_files:
-            for fname in deleted_files:
-                fpath = os.path.join(name['dir-name'], fname)
+        failures = []
+
+        changed = set(path for path in set(cur) & set(bak)
+                      if cur[path] != bak[path] and path != 'dir-name')
+        for rel_path in sorted(changed):
+            fpath = os.path.join(dirname, rel_path)
+            stored = self.store_path(dirname, rel_path)
+            if (cur[rel_path].startswith('file') and
+                    bak[rel_path].startswith('file') and
+                    os.path.isfile(stored) and
+                    os.stat(stored).st_ino == os.stat(fpath).st_ino):
+                failures.append('%s was modified in place, and only a hard '
+                                'link was stored' % rel_path)
+                changed.remove(rel_path)
+        # Remove created and changed entries, parents before children.
+        for rel_path in sorted((set(cur) - set(bak)) | changed):
+            fpath = os.path.join(dirname, rel_path)
+            if os.path.isdir(fpath) and not os.path.islink(fpath):
+                shutil.rmtree(fpath)
+            elif os.path.lexists(fpath):
+                os.remove(fpath)
+
+        # Restore deleted and changed entries, parents before children.
+        for rel_path in sorted((set(bak) - set(cur)) | changed):
+            fpath = os.path.join(dirname, rel_path)
+            info = bak[rel_path]
+            if os.path.lexists(fpath):
+                continue
+            if info == 'dir':
+                os.makedirs(fpath)
+            elif info.startswith('link '):
+                os.symlink(info.split(' -> ', 1)[1], fpath)
+            elif info == 'special':
+                failures.append('%s is a special file' % rel_path)
+            elif os.path.isfile(self.store_path(dirname, rel_path)):
+                self.clone_file(self.store_path(dirname, rel_path), fpath)
+            else:
+                failures.append('%s was not stored' % rel_path)
                 open(fpath, 'a').close()
-        # TODO: record file/dir info and recover them separately
+        if failures:
+            raise Exception('Failed to restore files in %s:\n%s' %
+                            (dirname, '\n'.join(failures)))
 
     def get_info(self, name):
+        """
+        List a directory tree with types of entries. Listings of
+        directories whose mtime didn't change since the last call are
+        reused, unless it was too close to that call to tell changes
+        apart.
+        """
         infos = {}
         infos['dir-name'] = name
-        for f in os.listdir(name):
-            infos[f] = f
+        listings = {}
+
+        def scan(path, rel_dir):
+            try:
+                mtime = os.lstat(path).st_mtime
+                listing = self.listings.get(path)
+                if (listing is None or listing[0] != mtime or
+                        mtime > listing[1] - 1):
+                    listing = (mtime, time.time(), os.listdir(path))
+                listings[path] = listing
+            except OSError:
+                return
+            for fname in listing[2]:
+                if fname == self.store_name:
+                    continue
+                fpath = os.path.join(path, fname)
+                rel_path = os.path.join(rel_dir, fname)
+                try:
+                    st = os.lstat(fpath)
+                except OSError:
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    infos[rel_path] = 'link -> %s' % os.readlink(fpath)
+                elif stat.S_ISDIR(st.st_mode):
+                    infos[rel_path] = 'dir'
+                    if rel_dir or fname not in self.permit_keys:
+                        scan(fpath, rel_path)
+                elif stat.S_ISREG(st.st_mode):
+                    if re.match(self.image_re, fname):
+                        infos[rel_path] = 'file'
+                    else:
+                        # Whole seconds, as restoring rounds mtime.
+                        infos[rel_path] = 'file size %d mtime %d ino %d' % (
+                            st.st_size, st.st_mtime, st.st_ino)
+                else:
+                    infos[rel_path] = 'special'
+
+        scan(name, '')
+        for path in [p for p in self.listings if p == name or
+                     p.startswith(name.rstrip('/') + '/')]:
+            del self.listings[path]
+        self.listings.update(listings)
         return infos
 
     def get_names(self):
@@ -726,83 +1480,2727 @@ class DirState(State):
 
 
 class FileState(State):
+
+    """
+    Contents of system files matching some globs.
+
+    Files are compared by a digest of their content, which is only
+    read again when their stat changed. The version at backup is kept
+    compressed to restore, and to show what changed.
+    """
     name = 'file'
-    permit_keys = []
+    recover_level = 1
+    # Content is only put in infos of changed files.
+    permit_keys = ['stat', 'content']
     permit_re = []
+    patterns = ['/etc/exports',
+                '/etc/hosts',
+                '/etc/libvirt/*.conf',
+                '/etc/sysconfig/libvirtd']
+
+    def __init__(self, uri=None, patterns=None):
+        State.__init__(self, uri)
+        if patterns:
+            self.patterns = self.patterns + patterns
+        self.backup_state = {}
+        # File path -> (stat, digest, compressed content) of last read.
+        self.cache = {}
+        self.stored = {}
+
+    def backup(self):
+        self.backup_state = {}
+        State.backup(self)
+        self.stored = dict((path, self.cache[path][2])
+                           for path in self.backup_state)
+
+    def dump(self):
+        return {'backup': self.backup_state,
+                'stored': dict((path, content.encode('base64'))
+                               for path, content in self.stored.items())}
+
+    def load(self, data):
+        State.load(self, data)
+        self.stored = dict((path, content.decode('base64'))
+                           for path, content in data['stored'].items())
+
+    def snapshot(self):
+        state = self.get_state()
+        return state, dict((path, self.cache[path][2]) for path in state)
+
+    def revert(self, snapshot):
+        state, contents = snapshot
+        stored, self.stored = self.stored, contents
+        try:
+            return State.revert(self, state)
+        finally:
+            self.stored = stored
 
     def remove(self, name):
-        raise Exception('It is not wise to remove a system file %s' % name)
+        """
+        Remove a file created since the backup, which matched a watched
+        glob.
+        """
+        file_path = name['file-path']
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        self.cache.pop(file_path, None)
 
     def restore(self, name):
         file_path = name['file-path']
-        cur = self.current_state[file_path]
-        bak = self.backup_state[file_path]
-        if cur['content'] != bak['content']:
-            with open(file_path, 'w') as f:
-                f.write(bak['content'])
+        with open(file_path, 'w') as f:
+            f.write(zlib.decompress(self.stored[file_path]))
+        name.pop('content', None)
 
     def get_info(self, name):
         infos = {}
         infos['file-path'] = name
-        with open(name) as f:
-            infos['content'] = f.read()
+        st = os.stat(name)
+        infos['stat'] = 'size %d mtime %.6f ctime %.6f ino %d' % (
+            st.st_size, st.st_mtime, st.st_ctime, st.st_ino)
+        cached = self.cache.get(name)
+        if cached is None or cached[0] != infos['stat']:
+            with open(name) as f:
+                content = f.read()
+            cached = (infos['stat'], hashlib.sha1(content).hexdigest(),
+                      zlib.compress(content))
+            self.cache[name] = cached
+        infos['digest'] = cached[1]
+        bak = self.backup_state.get(name)
+        if bak is not None and bak['digest'] != infos['digest']:
+            infos['content'] = zlib.decompress(cached[2]).splitlines()
+            bak['content'] = zlib.decompress(
+                self.stored[name]).splitlines()
         return infos
 
     def get_names(self):
-        return ['/etc/exports',
-                '/etc/libvirt/libvirtd.conf',
-                '/etc/libvirt/qemu.conf']
+        names = set()
+        for pattern in self.patterns:
+            names.update(path for path in glob.glob(pattern)
+                         if os.path.isfile(path))
+        return sorted(names)
 
 
-class LibvirtCI():
+class RecoveryPlanner():
 
-    def parse_args(self):
-        parser = optparse.OptionParser(
-            description='Continuouse integration of '
-            'virt-test libvirt test provider.')
-        parser.add_option('--list', dest='list', action='store_true',
-                          help='List all the test names')
-        parser.add_option('--no', dest='no', action='store', default='',
-                          help='Exclude specified tests.')
-        parser.add_option('--only', dest='only', action='store', default='',
-                          help='Run only for specified tests.')
-        parser.add_option('--no-check', dest='no_check', action='store_true',
-                          help='Disable checking state changes after each test.')
-        parser.add_option('--no-recover', dest='no_recover', action='store_true',
-                          help='Disable recover state changes after each test.')
-        parser.add_option('--connect-uri', dest='connect_uri', action='store',
-                          default='', help='Run tests using specified uri.')
-        parser.add_option('--additional-vms', dest='add_vms', action='store',
-                          default='', help='Additional VMs for testing')
-        parser.add_option('--smoke', dest='smoke', action='store_true',
-                          help='Run one test for each script.')
-        parser.add_option('--slice', dest='slice', action='store',
-                          default='', help='Specify a URL to slice tests.')
-        parser.add_option('--report', dest='report', action='store',
-                          default='xunit_result.xml',
-                          help='Exclude specified tests.')
-        parser.add_option('--white', dest='whitelist', action='store',
-                          default='', help='Whitelist file contains '
-                          'specified test cases to run.')
-        parser.add_option('--black', dest='blacklist', action='store',
-                          default='', help='Blacklist file contains '
-                          'specified test cases to be excluded.')
-        parser.add_option('--config', dest='config', action='store',
-                          default='', help='Specify a custom Cartesian cfg '
-                          'file')
-        parser.add_option('--img-url', dest='img_url', action='store',
-                          default='', help='Specify a URL to a custom image '
-                          'file')
-        parser.add_option('--os-variant', dest='os_variant', action='store',
-                          default='', help='Specify the --os-variant option '
-                          'when doing virt-install.')
-        parser.add_option('--password', dest='password', action='store',
-                          default='', help='Specify a password for logging '
-                          'into guest')
-        parser.add_option('--pull-virt-test', dest='virt_test_pull',
-                          action='store', default='',
-                          help='Merge specified virt-test pull requests. '
-                          'Multiple pull requests are separated by ",", '
+    """
+    Recover changes of several states in dependency order.
+
+    Items are removed from the highest recover level down, so domains
+    go before the pools and networks they use, then restored from the
+    lowest level up: services, kernel modules, loop and device mapper
+    devices, mounts, files and directories, pools, networks and
+    secrets, then domains, links and firewall rules. Actions within
+    one level run concurrently. Failed actions are retried once, in the
+    same order, after all levels are done.
+    """
+
+    def __init__(self, max_threads=8):
+        self.max_threads = max_threads
+        self.actions = []
+
+    def add(self, state, action, info):
+        self.actions.append((state, action, info))
+
+    def phases(self, actions):
+        removes = [a for a in actions if a[1] == 'Remove']
+        restores = [a for a in actions if a[1] != 'Remove']
+        levels = sorted(set(a[0].recover_level for a in actions))
+        phases = []
+        for level in reversed(levels):
+            phases.append([a for a in removes if a[0].recover_level == level])
+        for level in levels:
+            phases.append([a for a in restores
+                           if a[0].recover_level == level])
+        return [phase for phase in phases if phase]
+
+    def run_phase(self, phase):
+        """
+        Run actions of a phase concurrently. Return failed actions
+        with their exceptions.
+        """
+        failures = []
+        lock = threading.Lock()
+        semaphore = threading.Semaphore(self.max_threads)
+
+        def run_action(state, action, info):
+            try:
+                state.recover_item(action, info)
+            except Exception, e:
+                traceback.print_exc()
+                with lock:
+                    failures.append(((state, action, info), e))
+            finally:
+                semaphore.release()
+
+        if len(phase) == 1:
+            semaphore.acquire()
+            run_action(*phase[0])
+            return failures
+
+        threads = []
+        for item in phase:
+            semaphore.acquire()
+            thread = threading.Thread(target=run_action, args=item)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return failures
+
+    def run(self):
+        """
+        Run all added actions.
+
+        :return: A dict using states as keys and lists of failure
+                 messages as values.
+        """
+        failed = []
+        for phase in self.phases(self.actions):
+            failed += [item for item, _ in self.run_phase(phase)]
+
+        failures = {}
+        for phase in self.phases(failed):
+            for item in phase:
+                state, action, _ = item
+                for _, e in self.run_phase([item]):
+                    failures.setdefault(state, []).append(
+                        '%s is failed:\n %s' % (action, e))
+        self.actions = []
+        return failures
+
+
+class StepGraph():
+
+    """
+    Run steps of environment preparation as a dependency graph.
+
+    A step starts as soon as all steps it depends on are done, so
+    independent steps run concurrently. Steps depending on a failed
+    step are skipped, and the first failure is raised after all
+    running steps are finished.
+    """
+
+    def __init__(self, profiler=None, max_threads=8):
+        self.profiler = profiler or Profiler()
+        self.max_threads = max_threads
+        self.steps = {}
+        self.order = []
+        self.times = {}
+
+    def add(self, name, func, deps=()):
+        """
+        Add a step. Dependencies not in the graph are ignored, so
+        optional steps can be depended on unconditionally.
+        """
+        self.steps[name] = (func, list(deps))
+        self.order.append(name)
+
+    def deps(self, name):
+        return [dep for dep in self.steps[name][1] if dep in self.steps]
+
+    def run(self):
+        done = set()
+        failed = {}
+        running = set()
+        cond = threading.Condition()
+
+        def run_step(name):
+            start_time = time.time()
+            error_info = None
+            try:
+                with self.profiler.phase('env:%s' % name):
+                    self.steps[name][0]()
+            except Exception, e:
+                traceback.print_exc()
+                error_info = e
+            with cond:
+                self.times[name] = (start_time, time.time())
+                running.discard(name)
+                if error_info is None:
+                    done.add(name)
+                else:
+                    failed[name] = error_info
+                cond.notify()
+
+        with cond:
+            pending = list(self.order)
+            while pending or running:
+                changed = False
+                for name in list(pending):
+                    deps = self.deps(name)
+                    if any(dep in failed for dep in deps):
+                        # Skipped, marked failed without an exception.
+                        pending.remove(name)
+                        failed[name] = None
+                        changed = True
+                    elif (len(running) < self.max_threads and
+                          all(dep in done for dep in deps)):
+                        pending.remove(name)
+                        running.add(name)
+                        thread = threading.Thread(target=run_step,
+                                                  args=(name,))
+                        thread.daemon = True
+                        thread.start()
+                if not changed and (pending or running):
+                    cond.wait()
+
+        for name in self.order:
+            if failed.get(name) is not None:
+                raise failed[name]
+
+    def critical_path(self):
+        """
+        Return the chain of steps that determined the finish time, as
+        a list of (name, duration).
+        """
+        if not self.times:
+            return []
+        name = max(self.times, key=lambda n: self.times[n][1])
+        path = []
+        while name is not None:
+            start_time, end_time = self.times[name]
+            path.append((name, end_time - start_time))
+            deps = [dep for dep in self.deps(name) if dep in self.times]
+            name = None
+            if deps:
+                name = max(deps, key=lambda n: self.times[n][1])
+        return list(reversed(path))
+
+
+class LibvirtdInstance():
+
+    """
+    A private libvirtd daemon with its own configuration, run directory,
+    socket and URI.
+
+    The daemon runs in a private mount namespace where libvirt's state
+    directories are bind mounted from this instance's root, so domains,
+    pools and secrets defined through it are invisible to the system
+    libvirtd and to other instances. Networks are copied from the host
+    with their bridges renamed and IPv4 addresses moved to 10.<100 +
+    index>.x.x, as bridges live in the shared network namespace, while
+    IPv6 addresses and MACs are dropped. Pools are copied with their
+    target directories made private, so volumes created in one instance
+    don't show up in others.
+
+    The system D-Bus is hidden from the daemon, so it doesn't register
+    domains with systemd-machined: every instance numbers domains from
+    1, and machine names like qemu-1-virt-tests-vm1 would collide.
+    """
+    base_dir = '/var/run/virt-test-ci'
+    private_dirs = ['/etc/libvirt',
+                    '/var/run/libvirt',
+                    '/var/lib/libvirt/qemu',
+                    '/var/lib/libvirt/dnsmasq',
+                    '/var/cache/libvirt',
+                    '/var/log/libvirt']
+    # Replaced by empty directories when they exist.
+    hidden_dirs = ['/var/run/dbus']
+
+    def __init__(self, name, index=1):
+        self.name = name
+        self.index = index
+        self.root = os.path.join(self.base_dir, name)
+        self.sock_dir = os.path.join(self.root, 'sock')
+        self.sock = os.path.join(self.sock_dir, 'libvirt-sock')
+        self.pid_file = os.path.join(self.root, 'libvirtd.pid')
+        self.log_file = os.path.join(self.root, 'libvirtd.log')
+        self.uri = 'qemu:///system?socket=%s' % self.sock
+        self.proc = None
+
+    def private_path(self, path):
+        return os.path.join(self.root, path.strip('/').replace('/', '_'))
+
+    def setup(self):
+        """
+        Create the directory tree of this instance from the host one.
+        """
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.sock_dir)
+        for path in self.private_dirs:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            private = self.private_path(path)
+            if path == '/etc/libvirt':
+                shutil.copytree(path, private, symlinks=True)
+            else:
+                os.mkdir(private)
+
+        for path in self.hidden_dirs:
+            if os.path.isdir(path):
+                os.mkdir(self.private_path(path))
+
+        # Start with no domains, keep networks, pools and secrets.
+        etc_dir = self.private_path('/etc/libvirt')
+        for sub_dir in ['qemu', 'qemu/autostart']:
+            sub_dir = os.path.join(etc_dir, sub_dir)
+            if not os.path.isdir(sub_dir):
+                continue
+            for fname in os.listdir(sub_dir):
+                if fname.endswith('.xml'):
+                    os.remove(os.path.join(sub_dir, fname))
+
+        network_dir = os.path.join(etc_dir, 'qemu', 'networks')
+        if os.path.isdir(network_dir):
+            for fname in os.listdir(network_dir):
+                if fname.endswith('.xml'):
+                    self._make_network_private(
+                        os.path.join(network_dir, fname))
+
+        storage_dir = os.path.join(etc_dir, 'storage')
+        if os.path.isdir(storage_dir):
+            for fname in os.listdir(storage_dir):
+                if fname.endswith('.xml'):
+                    self._make_pool_private(os.path.join(storage_dir, fname))
+
+        self._set_options(os.path.join(etc_dir, 'libvirtd.conf'),
+                          {'unix_sock_dir': '"%s"' % self.sock_dir})
+        # virtlogd socket is hidden by the private /var/run/libvirt.
+        self._set_options(os.path.join(etc_dir, 'qemu.conf'),
+                          {'stdio_handler': '"file"'})
+
+    def _make_network_private(self, xml_path):
+        with open(xml_path) as fp:
+            net_xml = fp.read()
+
+        def bridge(match):
+            name = ('vtc%d-%s' % (self.index, match.group(3)))[:15]
+            return '%s%s%s%s' % (match.group(1), match.group(2), name,
+                                 match.group(2))
+
+        def address(match):
+            return "%s='10.%d.%s.%s'" % (match.group(1), 100 + self.index,
+                                         match.group(5), match.group(6))
+
+        net_xml = re.sub(r'(<bridge\s[^>]*?name=)([\'"])(.*?)\2', bridge,
+                         net_xml)
+        net_xml = re.sub(r'\b(address|start|end|ip)=([\'"])(\d+)\.(\d+)\.'
+                         r'(\d+)\.(\d+)\2', address, net_xml)
+        net_xml = re.sub(r'\s*<ip\s[^>]*?family=[\'"]ipv6[\'"][^>]*?'
+                         r'(?:/>|>.*?</ip>)', '', net_xml, flags=re.S)
+        net_xml = re.sub(r'\s*<mac\s[^>]*/>', '', net_xml)
+        with open(xml_path, 'w') as fp:
+            fp.write(net_xml)
+
+    def resolve(self, path):
+        """
+        Return where the daemon's view of _path_ is on the host.
+        """
+        for private_dir in self.private_dirs:
+            if path == private_dir or path.startswith(private_dir + '/'):
+                return os.path.join(self.private_path(private_dir),
+                                    path[len(private_dir):].lstrip('/'))
+        return path
+
+    def _make_pool_private(self, xml_path):
+        with open(xml_path) as fp:
+            pool_xml = fp.read()
+        match = re.search(r'<pool type=[\'"](dir|fs|netfs)[\'"]', pool_xml)
+        target = re.search(r'<target>\s*<path>(.*?)</path>', pool_xml, re.S)
+        if not match or not target:
+            return
+        private = self.private_path(target.group(1))
+        if not os.path.isdir(private):
+            os.makedirs(private)
+        pool_xml = (pool_xml[:target.start(1)] + private +
+                    pool_xml[target.end(1):])
+        with open(xml_path, 'w') as fp:
+            fp.write(pool_xml)
+
+    def wrap_run(self, cmd):
+        """
+        Wrap a virt-test run command so it gets its own env file and tmp
+        directory, which runs of other workers would otherwise share.
+        """
+        script = ['mount --make-rprivate /']
+        env_file = os.path.join(data_dir.get_root_dir(), 'backends',
+                                'libvirt', 'env')
+        if not os.path.exists(env_file):
+            open(env_file, 'a').close()
+        private_env = self.private_path(env_file)
+        if not os.path.exists(private_env):
+            open(private_env, 'a').close()
+        private_tmp = self.private_path(data_dir.get_tmp_dir())
+        if not os.path.isdir(private_tmp):
+            os.makedirs(private_tmp)
+        script.append('mount --bind %s %s' % (private_env, env_file))
+        script.append('mount --bind %s %s' % (private_tmp,
+                                              data_dir.get_tmp_dir()))
+        script.append('exec %s' % cmd)
+        return 'unshare --mount sh -c %s' % pipes.quote(' && '.join(script))
+
+    def _set_options(self, conf, options):
+        lines = []
+        if os.path.exists(conf):
+            with open(conf) as fp:
+                for line in fp:
+                    key = line.split('=', 1)[0].strip()
+                    if key not in options:
+                        lines.append(line)
+        for key, value in options.items():
+            lines.append('%s = %s\n' % (key, value))
+        with open(conf, 'w') as fp:
+            fp.writelines(lines)
+
+    def start(self, timeout=60):
+        """
+        Start the daemon and wait for its socket to accept connections.
+        """
+        if self.is_running():
+            return True
+        script = ['mount --make-rprivate /']
+        for path in self.private_dirs + self.hidden_dirs:
+            if os.path.isdir(self.private_path(path)):
+                script.append('mount --bind %s %s' % (
+                    self.private_path(path), path))
+        script.append('exec libvirtd --pid-file %s' % self.pid_file)
+        log = open(self.log_file, 'a')
+        try:
+            self.proc = subprocess.Popen(
+                ['unshare', '--mount', 'sh', '-c', ' && '.join(script)],
+                stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+        finally:
+            log.close()
+
+        end_time = time.time() + timeout
+        while time.time() < end_time:
+            if self.proc.poll() is not None:
+                logging.error('libvirtd instance %s exited with %s, see %s',
+                              self.name, self.proc.returncode, self.log_file)
+                return False
+            if os.path.exists(self.sock):
+                res = virsh.command('uri', uri=self.uri, ignore_status=True)
+                if not res.exit_status:
+                    return True
+            time.sleep(0.5)
+        logging.error('Timeout waiting for libvirtd instance %s', self.name)
+        return False
+
+    def stop(self):
+        """
+        Destroy domains of this instance and stop the daemon.
+        """
+        if not self.is_running():
+            return True
+        res = virsh.dom_list(options='--name', uri=self.uri,
+                             ignore_status=True)
+        for dom in res.stdout.splitlines():
+            if dom.strip():
+                virsh.destroy(dom.strip(), uri=self.uri, ignore_status=True)
+        self.proc.terminate()
+        self.proc.wait()
+        self.proc = None
+        return True
+
+    def restart(self):
+        self.stop()
+        return self.start()
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def cleanup(self):
+        self.stop()
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def create_overlay(backing, overlay):
+    """
+    Create a qcow2 overlay of _backing_, giving its format as newer
+    qemu-img requires.
+    """
+    res = utils.run('qemu-img info --output=json %s' % backing)
+    backing_format = json.loads(res.stdout)['format']
+    utils.run('qemu-img create -f qcow2 -F %s -b %s %s' %
+              (backing_format, backing, overlay))
+
+
+class WarmPool():
+
+    """
+    A pool of booted guests saved to disk, so a test needing a running
+    VM gets one restored in seconds instead of booting it.
+
+    The guest is booted once on overlays of frozen copies of its disks
+    and saved with `virsh save`. Each slot of the pool is a copy of
+    these overlays. Restoring a slot resumes the saved guest on the
+    slot's own disks, while a background thread refills the pool. The
+    pool is given up after filling failed several times in a row.
+
+    A restored guest's disk sources are the slot overlays, not the paths
+    of the persistent definition a cold start uses, so tests matching
+    cold_re, which look at or operate on disks and snapshots, always
+    start the guest cold.
+    """
+    max_failures = 3
+    cold_re = (r'.*(snapshot|block|disk|domblk|volume|vol_|backing|'
+               r'save|managedsave|migrat|virt_sysprep|image)')
+
+    def __init__(self, vm_name, work_dir, size=2, uri=None,
+                 boot_timeout=300, username='root', password='123456',
+                 prompt=r'[\#\$]\s*$'):
+        self.vm_name = vm_name
+        self.username = username
+        self.password = password
+        self.prompt = prompt
+        self.work_dir = work_dir
+        self.size = size
+        self.uri = uri or None
+        self.boot_timeout = boot_timeout
+        self.save_file = os.path.join(work_dir, '%s.save' % vm_name)
+        self.overlays = []
+        self.saved_xml = None
+        self.slots = Queue.Queue(maxsize=size)
+        self.slot_count = 0
+        self.used_slot = None
+        self.stopped = threading.Event()
+        self.dead = threading.Event()
+        self.thread = None
+
+    def _virsh(self, cmd):
+        res = virsh.command(cmd, uri=self.uri, ignore_status=True)
+        if res.exit_status:
+            raise Exception('Command "virsh %s" failed:\n%s' % (cmd, res))
+        return res
+
+    def _define(self, domxml):
+        xml_path = os.path.join(self.work_dir, '%s.xml' % self.vm_name)
+        with open(xml_path, 'w') as fp:
+            fp.write(domxml)
+        try:
+            self._virsh('define %s' % xml_path)
+        finally:
+            os.remove(xml_path)
+
+    def wait_for_boot(self):
+        """
+        Wait until the guest has an IP address and can be logged into
+        with SSH.
+        """
+        end_time = time.time() + self.boot_timeout
+        while time.time() < end_time:
+            res = virsh.command('domifaddr %s' % self.vm_name, uri=self.uri,
+                                ignore_status=True)
+            for addr in re.findall(r'ipv4\s+([0-9.]+)/', res.stdout):
+                sock = socket.socket()
+                sock.settimeout(2)
+                try:
+                    sock.connect((addr, 22))
+                except socket.error:
+                    continue
+                finally:
+                    sock.close()
+                try:
+                    session = remote.wait_for_login(
+                        'ssh', addr, 22, self.username, self.password,
+                        self.prompt, timeout=30)
+                except Exception, e:
+                    logging.debug('Failed to log into %s: %s',
+                                  self.vm_name, e)
+                    continue
+                session.close()
+                return
+            time.sleep(2)
+        raise Exception('Timeout waiting for %s to boot' % self.vm_name)
+
+    def setup(self):
+        """
+        Boot and save the guest, then start filling the pool.
+        """
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        os.makedirs(self.work_dir)
+
+        inactive_xml = self._virsh(
+            'dumpxml %s --inactive' % self.vm_name).stdout
+        warm_xml = inactive_xml
+        paths = sorted(set(re.findall(r"<source file=['\"]([^'\"]+)['\"]",
+                                      inactive_xml)))
+        for idx, path in enumerate(paths):
+            frozen = os.path.join(self.work_dir, 'frozen-%d.img' % idx)
+            overlay = os.path.join(self.work_dir, 'warm-%d.qcow2' % idx)
+            utils.run('cp --sparse=always %s %s' % (path, frozen))
+            create_overlay(frozen, overlay)
+            warm_xml = warm_xml.replace(path, overlay)
+            self.overlays.append(overlay)
+
+        virsh.destroy(self.vm_name, uri=self.uri, ignore_status=True)
+        self._define(warm_xml)
+        try:
+            self._virsh('start %s' % self.vm_name)
+            self.wait_for_boot()
+            self._virsh('save %s %s --running' % (self.vm_name,
+                                                  self.save_file))
+        finally:
+            virsh.destroy(self.vm_name, uri=self.uri, ignore_status=True)
+            self._define(inactive_xml)
+        self.saved_xml = self._virsh(
+            'save-image-dumpxml %s' % self.save_file).stdout
+
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _new_slot(self):
+        self.slot_count += 1
+        slot_dir = os.path.join(self.work_dir, 'slot-%d' % self.slot_count)
+        os.mkdir(slot_dir)
+        slot_xml = self.saved_xml
+        for overlay in self.overlays:
+            slot_disk = os.path.join(slot_dir, os.path.basename(overlay))
+            utils.run('cp --sparse=always %s %s' % (overlay, slot_disk))
+            slot_xml = slot_xml.replace(overlay, slot_disk)
+        with open(os.path.join(slot_dir, 'domain.xml'), 'w') as fp:
+            fp.write(slot_xml)
+        return slot_dir
+
+    def _fill(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                slot_dir = self._new_slot()
+            except Exception:
+                traceback.print_exc()
+                failures += 1
+                if failures >= self.max_failures:
+                    logging.warning('Giving up warm guests of %s',
+                                    self.vm_name)
+                    self.dead.set()
+                    return
+                self.stopped.wait(5 * 2 ** failures)
+                continue
+            failures = 0
+            while not self.stopped.is_set():
+                try:
+                    self.slots.put(slot_dir, timeout=1)
+                    break
+                except Queue.Full:
+                    continue
+
+    def restore(self, timeout=60):
+        """
+        Replace the guest with a running one from the pool.
+
+        :return: True if the guest is restored.
+        """
+        end_time = time.time() + timeout
+        slot_dir = None
+        while slot_dir is None:
+            try:
+                slot_dir = self.slots.get(timeout=1)
+            except Queue.Empty:
+                if self.dead.is_set() or time.time() > end_time:
+                    logging.warning('No warm guest ready for %s',
+                                    self.vm_name)
+                    return False
+        virsh.destroy(self.vm_name, uri=self.uri, ignore_status=True)
+        self._release_used_slot()
+        self.used_slot = slot_dir
+        res = virsh.command('restore %s --xml %s' % (
+            self.save_file, os.path.join(slot_dir, 'domain.xml')),
+            uri=self.uri, ignore_status=True)
+        if res.exit_status:
+            logging.warning('Failed to restore warm guest %s:\n%s',
+                            self.vm_name, res)
+            return False
+        return True
+
+    def _release_used_slot(self):
+        if self.used_slot is not None:
+            shutil.rmtree(self.used_slot, ignore_errors=True)
+            self.used_slot = None
+
+    def cleanup(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.used_slot is not None:
+            virsh.destroy(self.vm_name, uri=self.uri, ignore_status=True)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class Worker():
+
+    """
+    A test runner bound to one libvirtd, either the system libvirtd
+    or a private LibvirtdInstance.
+    """
+
+    def __init__(self, name, uri=None, instance=None, watch_files=None):
+        self.name = name
+        self.instance = instance
+        self.late_diffs = []
+        self.warm_pool = None
+        if instance is not None:
+            uri = instance.uri
+        self.uri = uri or None
+        if instance is None:
+            # service must put at first, or the result will be wrong.
+            self.states = [FileState(patterns=watch_files), ServiceState(),
+                           DirState(), DomainState(self.uri),
+                           NetworkState(self.uri), PoolState(self.uri),
+                           SecretState(self.uri), MountState(),
+                           LinkState(), LoopState(), DeviceMapperState(),
+                           FirewallState(), ModuleState()]
+        else:
+            self.states = [ServiceState(libvirtd=instance),
+                           DomainState(self.uri), NetworkState(self.uri),
+                           PoolState(self.uri), SecretState(self.uri)]
+
+    def qemu_run_dir(self):
+        """
+        Return the directory of qemu pid files.
+        """
+        if self.instance is None:
+            return '/var/run/libvirt/qemu'
+        return os.path.join(self.instance.private_path('/var/run/libvirt'),
+                            'qemu')
+
+    def log_files(self):
+        """
+        Return the libvirtd log file and the qemu log directory.
+        """
+        if self.instance is None:
+            return ('/var/log/libvirt/libvirtd.log',
+                    '/var/log/libvirt/qemu')
+        return (self.instance.log_file,
+                os.path.join(self.instance.private_path('/var/log/libvirt'),
+                             'qemu'))
+
+    def provision(self, vm_names, src_uri=None):
+        """
+        Define VMs of the source libvirtd into the private instance,
+        using a qcow2 overlay for each file backed disk.
+        """
+        for vm_name in vm_names:
+            res = virsh.dumpxml(vm_name, extra='--inactive', uri=src_uri,
+                                ignore_status=True)
+            if res.exit_status:
+                raise Exception('Failed to dumpxml %s:\n%s' % (vm_name, res))
+            domxml = res.stdout
+            for path in set(re.findall(r"<source file=['\"]([^'\"]+)['\"]",
+                                       domxml)):
+                overlay = os.path.join(
+                    self.instance.root,
+                    '%s-%s' % (vm_name, os.path.basename(path)))
+                create_overlay(path, overlay)
+                domxml = domxml.replace(path, overlay)
+
+            xml_path = os.path.join(self.instance.root, '%s.xml' % vm_name)
+            with open(xml_path, 'w') as fp:
+                fp.write(domxml)
+            res = virsh.define(xml_path, uri=self.uri, ignore_status=True)
+            os.remove(xml_path)
+            if res.exit_status:
+                raise Exception('Failed to define %s for worker %s:\n%s' %
+                                (vm_name, self.name, res))
+
+
+class History():
+
+    """
+    Per test records kept across CI runs in a JSON file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename and os.path.abspath(filename)
+        self.lock = threading.Lock()
+        self.tests = {}
+        if self.filename and os.path.exists(self.filename):
+            try:
+                with open(self.filename) as fp:
+                    self.tests = json.load(fp)
+            except ValueError:
+                logging.warning('Ignoring corrupted history file %s',
+                                self.filename)
+
+    def get(self, test, key, default=None):
+        with self.lock:
+            return self.tests.get(test, {}).get(key, default)
+
+    def record(self, test, **values):
+        with self.lock:
+            self.tests.setdefault(test, {}).update(values)
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            tmp_name = self.filename + '.tmp'
+            with open(tmp_name, 'w') as fp:
+                json.dump(self.tests, fp)
+            os.rename(tmp_name, self.filename)
+
+
+class BootstrapCache():
+
+    """
+    Remember what the data directory was bootstrapped from, so an
+    unchanged data directory can be reused by the next run.
+
+    The key covers commits and local changes of virt-test and
+    tp-libvirt, the --config file and options changing the generated
+    configs. Digests of generated config files are kept to find the
+    ones changed since.
+    """
+    version = 1
+    stamp_name = '.ci_bootstrap.json'
+
+    def __init__(self, args):
+        self.args = args
+        self.stamp_file = os.path.join(data_dir.get_data_dir(),
+                                       self.stamp_name)
+
+    @staticmethod
+    def file_digest(path):
+        digest = hashlib.sha1()
+        with open(path) as fp:
+            for chunk in iter(lambda: fp.read(65536), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def repo_state(self, path):
+        """
+        Return HEAD commit and a digest of local changes of a repo.
+        """
+        res = utils.run('cd %s && git rev-parse HEAD && git diff HEAD' %
+                        path, ignore_status=True)
+        if res.exit_status:
+            return None
+        commit, _, diff = res.stdout.partition('\n')
+        return [commit, hashlib.sha1(diff).hexdigest()]
+
+    def key(self):
+        values = {
+            'version': self.version,
+            'virt-test': self.repo_state(data_dir.get_root_dir()),
+            'tp-libvirt': self.repo_state(data_dir.get_test_provider_dir(
+                'io-github-autotest-libvirt')),
+            'config': None,
+        }
+        for opt in ['password', 'os_variant', 'add_vms', 'connect_uri']:
+            values[opt] = getattr(self.args, opt)
+        if self.args.config and os.path.isfile(self.args.config):
+            values['config'] = self.file_digest(self.args.config)
+        return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+    def config_files(self):
+        """
+        Return config files generated from samples by bootstrap.
+        """
+        root_dir = data_dir.get_root_dir()
+        files = []
+        for cfg_dir in [os.path.join(root_dir, 'shared', 'cfg'),
+                        os.path.join(root_dir, 'backends', 'libvirt', 'cfg')]:
+            if not os.path.isdir(cfg_dir):
+                continue
+            for fname in os.listdir(cfg_dir):
+                if fname.endswith('.cfg.sample'):
+                    files.append(os.path.join(cfg_dir, fname[:-7]))
+        return sorted(files)
+
+    def load(self):
+        try:
+            with open(self.stamp_file) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def check(self, key):
+        """
+        Check whether the data directory was bootstrapped with _key_.
+
+        :return: None on a miss, otherwise the list of generated
+                 config files changed or removed since.
+        """
+        stamp = self.load()
+        if not stamp or stamp.get('key') != key:
+            return None
+        changed = []
+        for path, digest in stamp.get('configs', {}).items():
+            if not os.path.isfile(path) or self.file_digest(path) != digest:
+                changed.append(path)
+        return changed
+
+    def save(self, key):
+        configs = dict((path, self.file_digest(path))
+                       for path in self.config_files()
+                       if os.path.isfile(path))
+        tmp_name = self.stamp_file + '.tmp'
+        with open(tmp_name, 'w') as fp:
+            json.dump({'key': key, 'configs': configs}, fp)
+        os.rename(tmp_name, self.stamp_file)
+
+
+class HostBaseline():
+
+    """
+    Backups of host wide states kept across CI runs in a JSON file,
+    along with a fingerprint of the host they were taken on.
+    """
+    version = 1
+
+    def __init__(self, filename, args):
+        self.filename = filename and os.path.abspath(filename)
+        self.args = args
+
+    def fingerprint(self, workers):
+        uname = os.uname()
+        res = utils.run('libvirtd --version', ignore_status=True)
+        values = {
+            'version': self.version,
+            'host': uname[1],
+            'kernel': uname[2],
+            'libvirt': res.stdout.strip(),
+            'workers': [(w.name, w.uri) for w in workers],
+            'synthetic': self.args.synthetic_host,
+            'replay': self.args.virsh_replay,
+            'watch files': self.args.watch_files,
+        }
+        return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+    @staticmethod
+    def encode(obj):
+        if isinstance(obj, set):
+            return {'__set__': sorted(obj)}
+        raise TypeError('%r is not JSON serializable' % obj)
+
+    @classmethod
+    def decode(cls, obj):
+        """
+        Turn loaded JSON back to what states hold: str rather than
+        unicode, and sets.
+        """
+        if isinstance(obj, dict):
+            if obj.keys() == ['__set__']:
+                return set(cls.decode(obj['__set__']))
+            return dict((cls.decode(key), cls.decode(value))
+                        for key, value in obj.items())
+        if isinstance(obj, list):
+            return [cls.decode(value) for value in obj]
+        if isinstance(obj, unicode):
+            return obj.encode('utf-8')
+        return obj
+
+    def load(self, fingerprint):
+        """
+        Return stored data of states by class name, or None when there
+        is no baseline for this host.
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename) as fp:
+                baseline = json.load(fp)
+        except ValueError:
+            logging.warning('Ignoring corrupted host baseline %s',
+                            self.filename)
+            return None
+        if baseline.get('fingerprint') != fingerprint:
+            print 'Host changed since the baseline in %s was stored' % (
+                self.filename)
+            return None
+        return self.decode(baseline['states'])
+
+    def save(self, fingerprint, states):
+        if not self.filename:
+            return
+        baseline = {
+            'fingerprint': fingerprint,
+            'states': dict((state.__class__.__name__, state.dump())
+                           for state in states),
+        }
+        tmp_name = self.filename + '.tmp'
+        try:
+            # Holds contents of watched files, keep it private.
+            fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600)
+            # Even when a stale tmp file was left with other modes.
+            os.fchmod(fd, 0600)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(baseline, fp, default=self.encode)
+        except (TypeError, ValueError), e:
+            logging.warning('Failed to store host baseline: %s', e)
+            os.remove(tmp_name)
+            return
+        os.rename(tmp_name, self.filename)
+
+
+class PerfTracker():
+
+    """
+    Keep a time series of test durations and libvirt_bench metrics in
+    a JSON lines file, and compare each run with a rolling baseline of
+    previous runs.
+
+    A value is a regression when it's worse than the mean of the last
+    _window_ values by more than _sigma_ standard deviations and by
+    more than _min_change_ of the mean. Older values are dropped from
+    the file.
+
+    Metrics of libvirt_bench tests are their CPU time, peak memory and
+    I/O accounted with cgroups, plus any the tests report themselves on
+    lines of their own, optionally after the "... | " prefix of log
+    lines, like:
+
+        BENCH_METRIC define count=1000
+        BENCH_METRIC define latency=1.5ms
+    """
+    bench_re = r'.*\blibvirt_bench\b'
+    # Metric patterns as (kind, regex, higher_is_worse).
+    metric_re = [
+        ('count', re.compile(
+            r'^(?:[^|\n]*\| )?BENCH_METRIC (?P<name>[\w.-]+) count='
+            r'(?P<value>[0-9]+)\s*$', re.M), False),
+        ('latency', re.compile(
+            r'^(?:[^|\n]*\| )?BENCH_METRIC (?P<name>[\w.-]+) latency='
+            r'(?P<value>[0-9.]+)(?P<unit>ms|us|s)?\s*$', re.M), True),
+    ]
+    units = {'us': 1e-6, 'ms': 1e-3, 's': 1.0, None: 1.0}
+
+    def __init__(self, filename, window=10, sigma=3.0, min_change=0.1,
+                 min_samples=3):
+        self.filename = filename and os.path.abspath(filename)
+        self.window = window
+        self.sigma = sigma
+        self.min_change = min_change
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        # (test, metric) -> items loaded from the file.
+        self.series = {}
+        self.current = []
+        self.run_time = time.time()
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename) as fp:
+                for line in fp:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.series.setdefault(
+                        (item['test'], item['metric']), []).append(item)
+
+    def extract(self, test, res):
+        """
+        Return metrics of a libvirt_bench test from its resource usage,
+        and found in its output and debug log, as a dict of name:
+        (value, higher_is_worse).
+
+        A metric reported again with another value keeps the first one.
+        The same value may well be found again, as the debug log holds
+        the output too.
+        """
+        metrics = {}
+        if not re.match(self.bench_re, test):
+            return metrics
+        usage = getattr(res, 'usage', None)
+        if usage is not None:
+            metrics['usage:cpu'] = (usage['cpu'] + usage['qemu_cpu'], True)
+            metrics['usage:mem'] = (usage['mem'] + usage['qemu_mem'], True)
+            metrics['usage:io'] = (usage['io_read'] + usage['io_write'],
+                                   True)
+        texts = [res.stdout, res.stderr]
+        debug_log = getattr(res, 'debug_log', None)
+        if debug_log and os.path.isfile(debug_log):
+            with open(debug_log) as fp:
+                texts.append(fp.read())
+        for text in texts:
+            for kind, regex, higher_is_worse in self.metric_re:
+                for match in regex.finditer(text):
+                    value = float(match.group('value'))
+                    if kind == 'latency':
+                        value *= self.units[match.groupdict().get('unit')]
+                    name = '%s:%s' % (kind, match.group('name'))
+                    if name not in metrics:
+                        metrics[name] = (value, higher_is_worse)
+                    elif metrics[name][0] != value:
+                        logging.warning('Ignoring %s of %s reported again: '
+                                        '%s, was %s', name, test, value,
+                                        metrics[name][0])
+        return metrics
+
+    def record(self, test, status, res):
+        """
+        Record duration and metrics of a passed test.
+        """
+        if not self.filename or not status.startswith('PASS'):
+            return
+        metrics = self.extract(test, res)
+        metrics['duration'] = (res.duration, True)
+        with self.lock:
+            for metric, (value, higher_is_worse) in metrics.items():
+                self.current.append((test, metric, value, higher_is_worse))
+
+    def compare(self):
+        """
+        Compare values of this run with their baselines.
+
+        :return: A list of (test, metric, value, mean, stdev, regressed),
+                 for values having enough previous samples.
+        """
+        results = []
+        for test, metric, value, higher_is_worse in self.current:
+            values = [item['value'] for item in
+                      self.series.get((test, metric), [])[-self.window:]]
+            if len(values) < self.min_samples:
+                continue
+            mean = sum(values) / len(values)
+            stdev = (sum((v - mean) ** 2 for v in values) /
+                     (len(values) - 1)) ** 0.5
+            change = value - mean if higher_is_worse else mean - value
+            regressed = (change > self.sigma * stdev and
+                         change > self.min_change * mean)
+            results.append((test, metric, value, mean, stdev, regressed))
+        return results
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            for test, metric, value, _ in self.current:
+                self.series.setdefault((test, metric), []).append(
+                    {'time': self.run_time, 'test': test, 'metric': metric,
+                     'value': value})
+            self.current = []
+            items = []
+            for key in self.series:
+                self.series[key] = self.series[key][-self.window:]
+                items += self.series[key]
+            items.sort(key=lambda item: item['time'])
+            tmp_name = self.filename + '.tmp'
+            with open(tmp_name, 'w') as fp:
+                for item in items:
+                    fp.write(json.dumps(item) + '\n')
+            os.rename(tmp_name, self.filename)
+
+
+class GitHubFetcher():
+
+    """
+    Fetch PR metadata and patches from GitHub.
+
+    Each URL is fetched at most once per run, also when requested by
+    several threads at the same time. Responses are kept in an on-disk
+    cache and revalidated with ETag or Last-Modified, so unchanged
+    resources don't count against the API rate limit.
+    """
+    auth = ('client_id=b6578298435c3eaa1e3d&client_secret'
+            '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
+
+    def __init__(self, cache_dir='', api_url='https://api.github.com',
+                 web_url='https://github.com', max_threads=4):
+        self.cache_dir = cache_dir and os.path.abspath(cache_dir)
+        self.api_url = api_url.rstrip('/')
+        self.web_url = web_url.rstrip('/')
+        self.max_threads = max_threads
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def _fetch(self, url):
+        request = urllib2.Request(url)
+        meta = {}
+        if self.cache_dir:
+            try:
+                with open(self._cache_path(url) + '.json') as fp:
+                    meta = json.load(fp)
+            except (IOError, ValueError):
+                meta = {}
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not meta:
+                raise
+            try:
+                with open(self._cache_path(url)) as fp:
+                    return fp.read()
+            except IOError:
+                # Cached content is gone, fetch it without the ETag.
+                response = urllib2.urlopen(urllib2.Request(url))
+        content = response.read()
+        if self.cache_dir:
+            headers = response.info()
+            meta = {'url': url, 'etag': headers.getheader('ETag'),
+                    'last_modified': headers.getheader('Last-Modified')}
+            path = self._cache_path(url)
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(path + '.tmp', 'w') as fp:
+                fp.write(content)
+            os.rename(path + '.tmp', path)
+            with open(path + '.json', 'w') as fp:
+                json.dump(meta, fp)
+        return content
+
+    def get(self, url):
+        """
+        Return content of a URL, waiting for another thread already
+        fetching it.
+        """
+        with self.lock:
+            result = self.results.get(url)
+            owner = result is None
+            if owner:
+                result = self.results[url] = {'done': threading.Event()}
+        if owner:
+            try:
+                result['content'] = self._fetch(url)
+            except Exception, e:
+                result['error'] = e
+            result['done'].set()
+        result['done'].wait()
+        if 'error' in result:
+            raise result['error']
+        return result['content']
+
+    def map(self, func, items):
+        """
+        Run func on items with a bounded number of threads. Return the
+        results in the order of items.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+        semaphore = threading.Semaphore(self.max_threads)
+
+        def run(idx, item):
+            try:
+                results[idx] = func(item)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                semaphore.release()
+
+        threads = []
+        for idx, item in enumerate(items):
+            semaphore.acquire()
+            thread = threading.Thread(target=run, args=(idx, item))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def issue(self, repo_name, number):
+        return json.loads(self.get('%s/repos/autotest/%s/issues/%s?%s' % (
+            self.api_url, repo_name, number, self.auth)))
+
+    def comments(self, repo_name, number):
+        return json.loads(self.get(
+            '%s/repos/autotest/%s/issues/%s/comments?%s' % (
+                self.api_url, repo_name, number, self.auth)))
+
+    def pr_open(self, repo_name, number):
+        return self.issue(repo_name, number)['state'] == 'open'
+
+    def patch(self, repo_name, number):
+        return self.get('%s/autotest/%s/pull/%s.patch' % (
+            self.web_url, repo_name, number))
+
+
+class GitMirror():
+
+    """
+    A bare mirror of a local checkout, shared by CI runs on the host,
+    to create detached worktrees for testing PRs from.
+
+    Commands changing the mirror hold a file lock, so concurrent runs
+    can use it safely.
+    """
+
+    def __init__(self, mirror_dir, name):
+        self.path = os.path.join(os.path.abspath(mirror_dir), '%s.git' % name)
+        self.lock_file = self.path + '.lock'
+        if not os.path.isdir(mirror_dir):
+            try:
+                os.makedirs(mirror_dir)
+            except OSError:
+                # Created by another run.
+                pass
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lock_file, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def git(self, cmd):
+        return utils.run('git --git-dir=%s %s' % (self.path, cmd))
+
+    def update(self, src_dir):
+        """
+        Fetch branches and HEAD of a checkout into the mirror. Return
+        the commit of HEAD.
+        """
+        commit = utils.run('cd %s && git rev-parse HEAD' %
+                           src_dir).stdout.strip()
+        with self.locked():
+            if not os.path.isdir(self.path):
+                utils.run('git clone --mirror %s %s' % (src_dir, self.path))
+            self.git('fetch --prune %s +refs/heads/*:refs/heads/* HEAD' %
+                     src_dir)
+            # Patches are applied with the identity of the checkout.
+            for key in ['user.name', 'user.email']:
+                res = utils.run('cd %s && git config %s' % (src_dir, key),
+                                ignore_status=True)
+                if not res.exit_status:
+                    self.git("config %s '%s'" % (key, res.stdout.strip()))
+        return commit
+
+    def add_worktree(self, path, commit):
+        with self.locked():
+            self.git('worktree add --detach %s %s' % (path, commit))
+
+    def prune(self):
+        if not os.path.isdir(self.path):
+            return
+        with self.locked():
+            self.git('worktree prune')
+
+
+class Scheduler():
+
+    """
+    Admission control in front of the test queue.
+
+    A test is started only when the host has enough free memory, load
+    and I/O wait are below limits, and its estimated footprint of
+    memory, CPUs and disk fits beside the tests already running. Tests
+    matching exclusive_re are run alone, and no test is started while one
+    of them is waiting.
+    """
+    exclusive_re = [r'.*\blibvirt_bench\b', r'.*\bblockcopy\b']
+    # Memory used by a guest beyond its configured RAM, and by ./run.
+    overhead_mem = 256 * 1024
+
+    def __init__(self, history=None, params=None, min_free_mem=1024,
+                 max_load=None, max_iowait=30):
+        self.history = history
+        self.params = params or {}
+        self.min_free_mem = min_free_mem * 1024
+        if max_load is None:
+            max_load = os.sysconf('SC_NPROCESSORS_ONLN')
+        self.max_load = float(max_load)
+        self.max_iowait = float(max_iowait)
+        self.running = {}
+        self.waiting_exclusive = 0
+        self.cond = threading.Condition()
+        self.last_cpu_times = self._cpu_times()
+
+    @staticmethod
+    def parse_size(size):
+        """
+        Return a size like "10G" in kB.
+        """
+        units = {'K': 1, 'M': 1024, 'G': 1024 ** 2, 'T': 1024 ** 3}
+        match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)', str(size).upper())
+        if not match:
+            return 0
+        return int(float(match.group(1)) * units.get(match.group(2),
+                                                     1.0 / 1024))
+
+    def estimate(self, test):
+        """
+        Estimate memory (kB), CPUs and disk (kB) used by a test, from
+        history when possible or else from its Cartesian params. Disk
+        from history is the I/O of the test, from params the sizes of
+        images besides the first one, which is kept between tests.
+        """
+        params = self.params.get(test, {})
+        vms = len(params.get('vms', 'virt-tests-vm1').split()) or 1
+        mem = self.history and self.history.get(test, 'mem')
+        if not mem:
+            mem = (int(params.get('mem', 1024)) * 1024 +
+                   self.overhead_mem) * vms
+        cpu = self.history and self.history.get(test, 'cpu')
+        if not cpu:
+            cpu = int(params.get('smp', params.get('vcpu', 1))) * vms
+        disk = self.history and self.history.get(test, 'io')
+        if disk:
+            disk /= 1024
+        else:
+            disk = sum(self.parse_size(params.get(
+                'image_size_%s' % image, params.get('image_size', 0)))
+                for image in params.get('images', '').split()[1:])
+        exclusive = any(re.match(r, test) for r in self.exclusive_re)
+        return {'mem': mem, 'cpu': cpu, 'disk': disk,
+                'exclusive': exclusive}
+
+    def _cpu_times(self):
+        with open('/proc/stat') as fp:
+            return [int(v) for v in fp.readline().split()[1:]]
+
+    def host_usage(self):
+        """
+        Return free memory (kB), 1 minute load and I/O wait percentage
+        since last call.
+        """
+        meminfo = {}
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+        free_mem = meminfo.get('MemAvailable')
+        if free_mem is None:
+            free_mem = (meminfo['MemFree'] + meminfo.get('Buffers', 0) +
+                        meminfo.get('Cached', 0))
+
+        with open('/proc/loadavg') as fp:
+            load = float(fp.read().split()[0])
+
+        cpu_times = self._cpu_times()
+        deltas = [new - old for new, old in
+                  zip(cpu_times, self.last_cpu_times)]
+        self.last_cpu_times = cpu_times
+        total = sum(deltas)
+        iowait = 100.0 * deltas[4] / total if total > 0 else 0.0
+        return free_mem, load, iowait
+
+    def admissible(self, est):
+        if not est['exclusive'] and self.waiting_exclusive:
+            return False
+        if not self.running:
+            return True
+        if est['exclusive'] or any(e['exclusive']
+                                   for e in self.running.values()):
+            return False
+
+        free_mem, load, iowait = self.host_usage()
+        if free_mem - est['mem'] < self.min_free_mem:
+            return False
+        reserved_cpu = sum(e['cpu'] for e in self.running.values())
+        if max(load, reserved_cpu) + est['cpu'] > self.max_load:
+            return False
+        if iowait > self.max_iowait:
+            return False
+        if est['disk']:
+            stat = os.statvfs(data_dir.get_data_dir())
+            free_disk = stat.f_bavail * stat.f_frsize / 1024
+            reserved_disk = sum(e['disk'] for e in self.running.values())
+            if free_disk - reserved_disk < est['disk']:
+                return False
+        return True
+
+    def acquire(self, test):
+        """
+        Block until the test can be started.
+        """
+        est = self.estimate(test)
+        with self.cond:
+            if est['exclusive']:
+                self.waiting_exclusive += 1
+            try:
+                while not self.admissible(est):
+                    self.cond.wait(1)
+            finally:
+                if est['exclusive']:
+                    self.waiting_exclusive -= 1
+            self.running[test] = est
+
+    def release(self, test):
+        with self.cond:
+            self.running.pop(test, None)
+            self.cond.notify_all()
+
+
+class CgroupUsage():
+
+    """
+    Resource usage of one test: its ./run process tree in a cgroup v2
+    group, and the qemu processes of the worker's domains, which a
+    thread follows into their machine scopes while the test runs.
+    """
+
+    def __init__(self, group, qemu_run_dir, interval=1.0):
+        self.group = group
+        self.qemu_run_dir = qemu_run_dir
+        self.interval = interval
+        self.scopes = {}
+        self.stop_event = threading.Event()
+        self.poll()
+        for scope in self.scopes.values():
+            # Usage of domains running before the test is not its own.
+            scope['base'] = dict(scope['last'])
+            scope['mem'] = scope['last'].get('mem_current', 0)
+        self.thread = threading.Thread(target=self._follow)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def poll(self):
+        if not os.path.isdir(self.qemu_run_dir):
+            return
+        for fname in os.listdir(self.qemu_run_dir):
+            if not fname.endswith('.pid'):
+                continue
+            try:
+                with open(os.path.join(self.qemu_run_dir, fname)) as fp:
+                    pid = int(fp.read().strip())
+                with open('/proc/%d/cgroup' % pid) as fp:
+                    path = [line.split('::', 1)[1].strip() for line in fp
+                            if line.startswith('0::')][0]
+            except (IOError, ValueError, IndexError):
+                continue
+            stats = CgroupAccounting.read_stats(
+                os.path.join(CgroupAccounting.root, path.lstrip('/')))
+            if not stats:
+                continue
+            scope = self.scopes.setdefault(path, {'base': {}, 'mem': 0})
+            scope['last'] = stats
+            mem = stats.get('mem_current', 0)
+            if not scope['base']:
+                mem = max(mem, stats.get('mem_peak', 0))
+            scope['mem'] = max(scope['mem'], mem)
+
+    def _follow(self):
+        while not self.stop_event.wait(self.interval):
+            self.poll()
+
+    def finish(self):
+        """
+        Return the usage as a dict of cpu (s), mem (peak kB), io_read,
+        io_write (bytes) and psi_cpu, psi_mem, psi_io (s), and the
+        cpu (s) and mem (kB) of qemu processes.
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.poll()
+        stats = CgroupAccounting.read_stats(self.group)
+        usage = {
+            'cpu': stats.get('cpu_usec', 0) / 1e6,
+            'mem': max(stats.get('mem_peak', 0),
+                       stats.get('mem_current', 0)) / 1024,
+            'io_read': stats.get('io_read', 0),
+            'io_write': stats.get('io_write', 0),
+            'psi_cpu': stats.get('psi_cpu', 0) / 1e6,
+            'psi_mem': stats.get('psi_memory', 0) / 1e6,
+            'psi_io': stats.get('psi_io', 0) / 1e6,
+            'qemu_cpu': 0.0,
+            'qemu_mem': 0,
+        }
+        for scope in self.scopes.values():
+            last, base = scope['last'], scope['base']
+            usage['qemu_cpu'] += (last.get('cpu_usec', 0) -
+                                  base.get('cpu_usec', 0)) / 1e6
+            usage['qemu_mem'] += scope['mem'] / 1024
+            for key in ['io_read', 'io_write']:
+                usage[key] += last.get(key, 0) - base.get(key, 0)
+        return usage
+
+
+class CgroupAccounting():
+
+    """
+    Run tests in cgroup v2 groups under /sys/fs/cgroup/virt-test-ci to
+    account their CPU, memory, I/O and pressure stalls.
+
+    Controllers are only enabled for the children of that parent group,
+    and only those the host already delegates to it. The previous
+    setting is restored, and the group removed when created, by
+    cleanup().
+    """
+    root = '/sys/fs/cgroup'
+    controllers = ['cpu', 'memory', 'io']
+
+    def __init__(self, name='virt-test-ci', enabled=True):
+        self.path = os.path.join(self.root, name)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.available = False
+        self.created = False
+        self.enabled = []
+        if not enabled:
+            return
+        if not os.path.exists(os.path.join(self.root, 'cgroup.controllers')):
+            logging.warning('cgroup v2 is not mounted at %s, not '
+                            'accounting test resources', self.root)
+            return
+        try:
+            if not os.path.isdir(self.path):
+                os.mkdir(self.path)
+                self.created = True
+            with open(os.path.join(self.path, 'cgroup.controllers')) as fp:
+                delegated = fp.read().split()
+            with open(os.path.join(self.path,
+                                   'cgroup.subtree_control')) as fp:
+                previous = fp.read().split()
+            for controller in self.controllers:
+                if controller in previous:
+                    continue
+                if controller not in delegated:
+                    logging.warning('cgroup controller %s is not enabled '
+                                    'for %s, not accounting it',
+                                    controller, self.path)
+                    continue
+                try:
+                    with open(os.path.join(self.path,
+                                           'cgroup.subtree_control'),
+                              'w') as fp:
+                        fp.write('+%s' % controller)
+                    self.enabled.append(controller)
+                except IOError, e:
+                    logging.warning('Failed to enable cgroup controller '
+                                    '%s: %s', controller, e)
+            self.remove_stale()
+            self.available = True
+        except (IOError, OSError), e:
+            logging.warning('Failed to create cgroup %s: %s', self.path, e)
+
+    @staticmethod
+    def read_stats(path):
+        """
+        Read cumulative counters of a cgroup. Missing files, e.g. of
+        controllers not enabled, are skipped.
+        """
+        stats = {}
+
+        def read(fname):
+            try:
+                with open(os.path.join(path, fname)) as fp:
+                    return fp.read()
+            except IOError:
+                return ''
+
+        for line in read('cpu.stat').splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'usage_usec':
+                stats['cpu_usec'] = int(value)
+        for fname, key in [('memory.peak', 'mem_peak'),
+                           ('memory.current', 'mem_current')]:
+            value = read(fname).strip()
+            if value.isdigit():
+                stats[key] = int(value)
+        for line in read('io.stat').splitlines():
+            for field in line.split()[1:]:
+                name, _, value = field.partition('=')
+                if name in ('rbytes', 'wbytes'):
+                    key = 'io_read' if name == 'rbytes' else 'io_write'
+                    stats[key] = stats.get(key, 0) + int(value)
+        for resource in ['cpu', 'memory', 'io']:
+            match = re.search(r'^some .*total=(\d+)',
+                              read('%s.pressure' % resource), re.M)
+            if match:
+                stats['psi_%s' % resource] = int(match.group(1))
+        return stats
+
+    def start(self, worker, label=None):
+        """
+        Create a group for a test of a worker, named after _label_ or
+        the worker, and this run.
+
+        :return: A CgroupUsage, or None when accounting isn't available.
+        """
+        if not self.available:
+            return None
+        with self.lock:
+            self.count += 1
+            group = os.path.join(self.path, '%s-%d-%d' % (
+                label or worker.name, os.getpid(), self.count))
+        try:
+            os.mkdir(group)
+        except OSError, e:
+            logging.warning('Failed to create cgroup %s, not accounting '
+                            'the test: %s', group, e)
+            return None
+        return CgroupUsage(group, worker.qemu_run_dir())
+
+    def wrap(self, usage, cmd):
+        """
+        Make a shell command move itself into the test's group.
+        """
+        if usage is None:
+            return cmd
+        return 'echo $$ > %s/cgroup.procs && exec %s' % (usage.group, cmd)
+
+    @staticmethod
+    def unwrap(cmd):
+        return re.sub(r'^echo \$\$ > \S+/cgroup\.procs && exec ', '', cmd)
+
+    def finish(self, usage):
+        """
+        Collect usage of a test and remove its group. Processes left
+        in the group are killed.
+        """
+        if usage is None:
+            return None
+        result = usage.finish()
+        try:
+            self.kill(usage.group)
+            os.rmdir(usage.group)
+        except (IOError, OSError), e:
+            logging.warning('Failed to remove cgroup %s: %s', usage.group, e)
+        return result
+
+    @staticmethod
+    def kill(group, timeout=10):
+        """
+        Kill processes in a group and wait for them to be gone.
+        """
+        procs = os.path.join(group, 'cgroup.procs')
+        end_time = time.time() + timeout
+        while True:
+            with open(procs) as fp:
+                pids = fp.read().split()
+            if not pids or time.time() > end_time:
+                return
+            for pid in pids:
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except OSError:
+                    pass
+            time.sleep(0.1)
+
+    def remove_stale(self):
+        """
+        Remove groups left by earlier runs which were killed. Groups
+        still having processes are left alone.
+        """
+        for fname in os.listdir(self.path):
+            group = os.path.join(self.path, fname)
+            if os.path.isdir(group):
+                try:
+                    os.rmdir(group)
+                except OSError, e:
+                    logging.warning('Failed to remove stale cgroup %s: %s',
+                                    group, e)
+
+    def cleanup(self):
+        """
+        Disable the controllers enabled for the parent group, and remove
+        it when it was created by this run.
+        """
+        try:
+            if self.created:
+                os.rmdir(self.path)
+                return
+            for controller in self.enabled:
+                with open(os.path.join(self.path, 'cgroup.subtree_control'),
+                          'w') as fp:
+                    fp.write('-%s' % controller)
+        except (IOError, OSError), e:
+            logging.warning('Failed to clean up cgroup %s: %s', self.path, e)
+
+
+class PreTestChecks():
+
+    """
+    Fix-ups of virt-tests-vm1 run before tests.
+
+    A check is skipped for a worker when the domain definition and the
+    existence of files it's registered with are the same as when it
+    last passed there without changing anything. The domain's XML is
+    dumped at most once per test, and only when a check has to run.
+    """
+
+    def __init__(self):
+        self.checks = []
+        self.keys = {}
+
+    def register(self, name, func, files=()):
+        """
+        Register func(worker, domxml) to be run before tests. It
+        returns True when it changed the domain.
+        """
+        self.checks.append((name, func, list(files)))
+
+    def run(self, worker, digest):
+        """
+        Run checks due for a worker. _digest_ identifies the current
+        domain definition, or is None when it's unknown.
+        """
+        domxml = None
+        for name, func, files in self.checks:
+            key = (digest, tuple(os.path.exists(f) for f in files))
+            if digest is not None and self.keys.get((worker.name,
+                                                     name)) == key:
+                continue
+            if domxml is None:
+                res = virsh.dumpxml('virt-tests-vm1',
+                                    ignore_status=True,
+                                    uri=worker.uri)
+                if res.exit_status:
+                    logging.warning('Failed to dumpxml from virt-tests-vm1'
+                                    '\n%s', res)
+                    return
+                domxml = res.stdout
+            if not func(worker, domxml) and digest is not None:
+                self.keys[(worker.name, name)] = key
+
+
+class LogWriter():
+
+    """
+    A file like object writing to a gzip file, usable as stdout and
+    stderr tee of utils.run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = gzip.open(path, 'wb')
+        self.lock = threading.Lock()
+        self.size = 0
+
+    def write(self, data):
+        with self.lock:
+            self.fp.write(data)
+            self.size += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+class LogStore():
+
+    """
+    Store output and debug log of each test in a compressed file, and
+    make bounded excerpts of them for the report. Logs of a test run
+    again in the same CI run are numbered, e.g. <test>.2.log.gz.
+    """
+    error_re = re.compile(r'ERROR|FAIL|Traceback')
+
+    def __init__(self, log_dir, excerpt_lines=100, context=3):
+        self.log_dir = os.path.abspath(log_dir)
+        self.excerpt_lines = excerpt_lines
+        self.context = context
+        self.lock = threading.Lock()
+        self.attempts = {}
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+    def open(self, test, suffix=''):
+        name = test + suffix
+        with self.lock:
+            attempt = self.attempts.get(name, 0) + 1
+            self.attempts[name] = attempt
+        if attempt > 1:
+            name = '%s.%d' % (name, attempt)
+        return LogWriter(os.path.join(self.log_dir, '%s.log.gz' % name))
+
+    def finish(self, writer, res):
+        """
+        Add debug log of virt-test to a test's log and close it. The
+        path of the debug log is saved as res.debug_log.
+        """
+        if not writer.size:
+            # Output was not streamed, e.g. replayed commands.
+            writer.write(res.stdout)
+            writer.write(res.stderr)
+        match = re.search(r'DEBUG LOG: (\S+)', res.stdout)
+        res.debug_log = match and match.group(1)
+        if res.debug_log and os.path.isfile(res.debug_log):
+            writer.write('\n==== %s ====\n' % res.debug_log)
+            with open(res.debug_log) as fp:
+                shutil.copyfileobj(fp, writer)
+        writer.close()
+
+    def excerpt(self, log):
+        """
+        Return lines around errors in a log, or its last lines if
+        there's no error, limited to excerpt_lines.
+        """
+        lines = log.splitlines()
+        selected = set()
+        for idx, line in enumerate(lines):
+            if self.error_re.search(line):
+                selected.update(range(max(0, idx - self.context),
+                                      min(len(lines), idx + self.context + 1)))
+        if not selected:
+            selected = range(max(0, len(lines) - self.excerpt_lines),
+                             len(lines))
+        excerpt = []
+        last_idx = -1
+        for idx in sorted(selected)[:self.excerpt_lines]:
+            if idx != last_idx + 1:
+                excerpt.append('...')
+            excerpt.append(lines[idx])
+            last_idx = idx
+        if last_idx != len(lines) - 1:
+            excerpt.append('...')
+        return '\n'.join(excerpt)
+
+
+class ArtifactCollector():
+
+    """
+    Pack the result directory, libvirtd log and qemu logs of each test
+    into a compressed archive in a background thread.
+
+    Log files are sliced by their sizes before and after the test.
+    Archives are indexed by test name in index.json, and the oldest
+    ones are removed when their total size exceeds the budget.
+    """
+
+    def __init__(self, artifact_dir, budget_mb=2048, queue_size=8):
+        self.artifact_dir = os.path.abspath(artifact_dir)
+        self.budget = budget_mb * 1024 * 1024
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.index_file = os.path.join(self.artifact_dir, 'index.json')
+        self.index = []
+        if not os.path.isdir(self.artifact_dir):
+            os.makedirs(self.artifact_dir)
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as fp:
+                    self.index = json.load(fp)
+            except ValueError:
+                logging.warning('Ignoring corrupted artifact index %s',
+                                self.index_file)
+        self.thread = threading.Thread(target=self._collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark(self, worker):
+        """
+        Return current sizes of log files of a worker.
+        """
+        libvirtd_log, qemu_log_dir = worker.log_files()
+        paths = [libvirtd_log]
+        if os.path.isdir(qemu_log_dir):
+            paths += [os.path.join(qemu_log_dir, fname)
+                      for fname in os.listdir(qemu_log_dir)
+                      if fname.endswith('.log')]
+        return dict((path, os.path.getsize(path)) for path in paths
+                    if os.path.isfile(path))
+
+    def submit(self, test, worker, res, marks):
+        """
+        Queue artifacts of a finished test to be packed. Blocks when
+        the queue is full.
+        """
+        slices = []
+        for path, end in self.mark(worker).items():
+            start = marks.get(path, 0)
+            if end < start:
+                # Log was rotated during the test.
+                start = 0
+            if end > start:
+                slices.append((path, start, end))
+        result_dir = None
+        debug_log = getattr(res, 'debug_log', None)
+        if debug_log:
+            result_dir = os.path.dirname(debug_log)
+        self.queue.put((test, result_dir, slices))
+
+    def _pack(self, test, result_dir, slices):
+        name = '%s-%s.tar.gz' % (test, time.strftime('%Y%m%d-%H%M%S'))
+        path = os.path.join(self.artifact_dir, name)
+        tar = tarfile.open(path, 'w:gz')
+        try:
+            if result_dir and os.path.isdir(result_dir):
+                tar.add(result_dir, arcname='results')
+            for log_path, start, end in slices:
+                info = tarfile.TarInfo(
+                    'logs/%s' % log_path.strip('/').replace('/', '_'))
+                info.size = end - start
+                info.mtime = time.time()
+                with open(log_path) as fp:
+                    fp.seek(start)
+                    tar.addfile(info, fp)
+        finally:
+            tar.close()
+        self.index.append({'test': test, 'archive': name,
+                           'size': os.path.getsize(path)})
+
+    def _rotate(self):
+        total = sum(item['size'] for item in self.index)
+        while self.index and total > self.budget:
+            item = self.index.pop(0)
+            total -= item['size']
+            try:
+                os.remove(os.path.join(self.artifact_dir, item['archive']))
+            except OSError:
+                pass
+
+    def _collect(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._pack(*item)
+                self._rotate()
+                tmp_name = self.index_file + '.tmp'
+                with open(tmp_name, 'w') as fp:
+                    json.dump(self.index, fp)
+                os.rename(tmp_name, self.index_file)
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        """
+        Wait until all queued artifacts are packed.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ReportWriter():
+
+    """
+    Update and save the report in a single background thread, so the
+    next test doesn't wait for them.
+
+    Tasks are run in the order they are submitted. The report is saved
+    whenever the queue gets empty, and when the writer is closed.
+    """
+
+    def __init__(self, report, filename, profiler=None, queue_size=16):
+        self.report = report
+        self.filename = filename
+        self.profiler = profiler or Profiler()
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, func, *args):
+        """
+        Queue func(report, *args) to be run. Blocks when the queue is
+        full.
+        """
+        self.queue.put((func, args))
+
+    def save(self):
+        with self.profiler.phase('report:save'):
+            self.report.save(self.filename)
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(self.report, *args)
+                if self.queue.empty():
+                    self.save()
+            except Exception:
+                traceback.print_exc()
+        self.save()
+
+    def close(self):
+        """
+        Wait until all queued tasks are done and the report is saved.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class EventStream():
+
+    """
+    Emit progress events as JSON lines to an append-only file or a
+    local socket, so consumers can follow a run without parsing the
+    report.
+
+    A target of 'unix:<path>' connects to a listening unix socket,
+    anything else is appended to as a file. Events are dropped after
+    the socket is gone.
+    """
+
+    def __init__(self, target=''):
+        self.fp = None
+        self.sock = None
+        self.lock = threading.Lock()
+        if target.startswith('unix:'):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(target[len('unix:'):])
+            except socket.error, e:
+                logging.warning('Failed to connect event socket %s: %s',
+                                target, e)
+                self.sock = None
+        elif target:
+            self.fp = open(target, 'a')
+
+    @staticmethod
+    def error_signature(err_msg):
+        """
+        Return first error line of a test with numbers and addresses
+        masked, so the same failure gets the same signature across runs.
+        """
+        for line in err_msg:
+            line = line.strip()
+            if not line or line.startswith('DIFF|'):
+                continue
+            line = re.sub(r'0x[0-9a-fA-F]+', '0x?', line)
+            line = re.sub(r'[0-9]+', 'N', line)
+            return line[:200]
+        return None
+
+    @classmethod
+    def decode(cls, value):
+        """
+        Decode strings taken from test output, which may not be UTF-8.
+        """
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        if isinstance(value, (list, tuple)):
+            return [cls.decode(item) for item in value]
+        if isinstance(value, dict):
+            return dict((cls.decode(key), cls.decode(item))
+                        for key, item in value.items())
+        return value
+
+    def emit(self, event, **values):
+        """
+        Emit an event. Failing to do so never stops the run.
+        """
+        if self.fp is None and self.sock is None:
+            return
+        try:
+            self._emit(event, values)
+        except Exception, e:
+            logging.warning('Failed to emit event %s: %s', event, e)
+
+    def _emit(self, event, values):
+        values['event'] = event
+        values['time'] = round(time.time(), 3)
+        line = json.dumps(self.decode(values)) + '\n'
+        with self.lock:
+            if self.fp is not None:
+                self.fp.write(line)
+                self.fp.flush()
+            elif self.sock is not None:
+                try:
+                    self.sock.sendall(line)
+                except socket.error, e:
+                    logging.warning('Event socket closed: %s', e)
+                    self.sock.close()
+                    self.sock = None
+
+    def test_finished(self, test, worker, status, res, err_msg):
+        diffs = [line.split('DIFF|', 1)[1] for line in err_msg
+                 if line.strip().startswith('DIFF|')]
+        self.emit('test_finished', test=test, worker=worker.name,
+                  status=status.split()[0], diff=bool(diffs),
+                  diff_summary=diffs[:5], diff_lines=len(diffs),
+                  duration=res.duration,
+                  error=self.error_signature(err_msg))
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+class Profiler():
+
+    """
+    Record wall and CPU time of CI phases, and the number of virsh
+    commands run in them.
+
+    CPU time is the user and system time of the CI process and its
+    finished children, so it also covers virsh and ./run processes,
+    but it's shared between concurrent phases when running workers in
+    parallel.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.time()
+
+    def install(self):
+        """
+        Count virsh commands by wrapping virttest.virsh.command.
+        """
+        if not self.enabled or hasattr(virsh.command, 'profiled'):
+            return
+        command = virsh.command
+        profiler = self
+
+        def counted_command(cmd, **dargs):
+            profiler.local.virsh_calls = (
+                getattr(profiler.local, 'virsh_calls', 0) + 1)
+            return command(cmd, **dargs)
+        counted_command.profiled = True
+        virsh.command = counted_command
+
+    @contextlib.contextmanager
+    def phase(self, name, test=None):
+        if not self.enabled:
+            yield
+            return
+        start_wall = time.time()
+        start_cpu = sum(os.times()[:4])
+        start_calls = getattr(self.local, 'virsh_calls', 0)
+        try:
+            yield
+        finally:
+            event = {'test': test,
+                     'phase': name,
+                     'thread': threading.current_thread().name,
+                     'start': start_wall - self.start_time,
+                     'wall': time.time() - start_wall,
+                     'cpu': sum(os.times()[:4]) - start_cpu,
+                     'virsh_calls': (getattr(self.local, 'virsh_calls', 0) -
+                                     start_calls)}
+            with self.lock:
+                self.events.append(event)
+
+    def save(self, filename):
+        """
+        Save the timeline as CSV if filename ends with .csv, or as JSON.
+        """
+        keys = ['start', 'thread', 'test', 'phase', 'wall', 'cpu',
+                'virsh_calls']
+        with self.lock:
+            events = list(self.events)
+        with open(filename, 'w') as fp:
+            if filename.endswith('.csv'):
+                writer = csv.DictWriter(fp, keys)
+                writer.writerow(dict(zip(keys, keys)))
+                for event in events:
+                    writer.writerow(event)
+            else:
+                json.dump(events, fp, indent=1)
+
+    def summary(self):
+        """
+        Return lines of a table of time spent in each phase.
+        """
+        phases = {}
+        with self.lock:
+            for event in self.events:
+                item = phases.setdefault(event['phase'], {
+                    'count': 0, 'wall': 0.0, 'max': 0.0,
+                    'cpu': 0.0, 'virsh_calls': 0})
+                item['count'] += 1
+                item['wall'] += event['wall']
+                item['max'] = max(item['max'], event['wall'])
+                item['cpu'] += event['cpu']
+                item['virsh_calls'] += event['virsh_calls']
+        lines = ['%-32s %6s %10s %9s %9s %10s %6s' % (
+            'Phase', 'Count', 'Wall(s)', 'Mean(s)', 'Max(s)', 'CPU(s)',
+            'Virsh')]
+        for name, item in sorted(phases.items(),
+                                 key=lambda p: p[1]['wall'], reverse=True):
+            lines.append('%-32s %6d %10.2f %9.3f %9.3f %10.2f %6d' % (
+                name[:32], item['count'], item['wall'],
+                item['wall'] / item['count'], item['max'], item['cpu'],
+                item['virsh_calls']))
+        return lines
+
+
+def install_command_backend(backend):
+    """
+    Route virttest.virsh.command and autotest utils.run through a
+    backend object, which gets the real function as first argument.
+    """
+    real_command = virsh.command
+    real_run = utils.run
+
+    def command(cmd, **dargs):
+        return backend.virsh(real_command, cmd, **dargs)
+
+    def run(cmd, *args, **dargs):
+        return backend.run(real_run, cmd, *args, **dargs)
+    virsh.command = command
+    utils.run = run
+
+
+class CommandRecorder():
+
+    """
+    Record virsh commands and utils.run calls with their results to a
+    JSON lines fixture.
+    """
+
+    def __init__(self, filename):
+        self.fp = open(filename, 'w')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _record(self, kind, cmd, uri, result, exception=None):
+        entry = {'kind': kind,
+                 'cmd': CgroupAccounting.unwrap(cmd).decode('utf-8',
+                                                            'replace'),
+                 'uri': uri,
+                 'exit_status': result.exit_status,
+                 'duration': result.duration,
+                 'exception': exception and exception.decode('utf-8',
+                                                             'replace')}
+        # Output which is not UTF-8 is kept byte for byte in base64.
+        for key in ['stdout', 'stderr']:
+            value = getattr(result, key)
+            try:
+                entry[key] = value.decode('utf-8')
+            except UnicodeDecodeError:
+                entry[key] = None
+                entry[key + '_base64'] = value.encode('base64')
+        with self.lock:
+            self.fp.write(json.dumps(entry) + '\n')
+            self.fp.flush()
+
+    def virsh(self, real_command, cmd, **dargs):
+        # utils.run calls made by virsh.command are not recorded twice.
+        self.local.in_virsh = True
+        try:
+            res = real_command(cmd, **dargs)
+        except error.CmdError, e:
+            self._record('virsh', cmd, dargs.get('uri'), e.result_obj,
+                         e.additional_text or '')
+            raise
+        finally:
+            self.local.in_virsh = False
+        self._record('virsh', cmd, dargs.get('uri'), res)
+        return res
+
+    def run(self, real_run, cmd, *args, **dargs):
+        if getattr(self.local, 'in_virsh', False):
+            return real_run(cmd, *args, **dargs)
+        try:
+            res = real_run(cmd, *args, **dargs)
+        except error.CmdError, e:
+            self._record('run', cmd, None, e.result_obj,
+                         e.additional_text or '')
+            raise
+        self._record('run', cmd, None, res)
+        return res
+
+
+class CommandReplayer():
+
+    """
+    Serve results of virsh commands and utils.run calls from a fixture
+    saved by CommandRecorder.
+
+    Results of the same command are served in recorded order, and the
+    last one is repeated when they are used up. Each result takes its
+    recorded duration divided by _speed_, or no time if _speed_ is 0.
+    """
+
+    def __init__(self, filename, speed=1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.results = {}
+        with open(filename) as fp:
+            for line in fp:
+                entry = json.loads(line)
+                key = (entry['kind'], entry['cmd'], entry['uri'])
+                self.results.setdefault(key, []).append(entry)
+
+    def _replay(self, kind, cmd, uri):
+        with self.lock:
+            entries = self.results.get((kind, cmd, uri))
+            if not entries:
+                entry = {'exit_status': 1, 'stdout': '',
+                         'stderr': 'error: no recorded result\n',
+                         'duration': 0, 'exception': None}
+            elif len(entries) > 1:
+                entry = entries.pop(0)
+            else:
+                entry = entries[0]
+        if self.speed:
+            time.sleep(entry['duration'] / self.speed)
+        outputs = []
+        for key in ['stdout', 'stderr']:
+            if entry[key] is None:
+                outputs.append(entry[key + '_base64'].decode('base64'))
+            else:
+                outputs.append(entry[key].encode('utf-8'))
+        res = utils.CmdResult(cmd, outputs[0], outputs[1],
+                              entry['exit_status'], entry['duration'])
+        if entry['exception'] is not None:
+            raise error.CmdError(cmd, res, entry['exception'] or None)
+        return res
+
+    def virsh(self, real_command, cmd, **dargs):
+        return self._replay('virsh', cmd, dargs.get('uri'))
+
+    def run(self, real_run, cmd, *args, **dargs):
+        return self._replay('run', cmd, None)
+
+
+class SyntheticHost():
+
+    """
+    Emulate a libvirt host with many domains, networks, pools and
+    secrets, answering the virsh commands used by State classes.
+
+    ./run calls list synthetic tests and pass them, installing defines
+    virt-tests-vm1, other utils.run calls succeed with no output.
+    """
+
+    def __init__(self, domains=100, networks=10, pools=10, volumes=100,
+                 secrets=10, tests=100, xml_lines=200, latency=0.0):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.xml_lines = xml_lines
+        self.tests = ['type_specific.io-github-autotest-libvirt.synthetic.'
+                      'test%d' % idx for idx in range(tests)]
+        self.domains = {}
+        for idx in range(domains):
+            self.add_domain('vm%d' % idx)
+        self.networks = {}
+        for idx in range(networks):
+            name = 'net%d' % idx
+            self.networks[name] = {'name': name, 'active': 'yes',
+                                   'persistent': 'yes', 'autostart': 'yes'}
+        self.pools = {}
+        for idx in range(pools):
+            name = 'pool%d' % idx
+            self.pools[name] = {
+                'name': name, 'state': 'running', 'persistent': 'yes',
+                'autostart': 'yes',
+                'volumes': ['vol%d.img' % vol for vol in range(volumes)]}
+        self.secrets = ['%08d-0000-0000-0000-000000000000' % idx
+                        for idx in range(secrets)]
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Create a host from a spec like "domains=1000,pools=50".
+        """
+        kwargs = {}
+        for item in spec.split(','):
+            if item:
+                key, value = item.split('=', 1)
+                kwargs[key] = float(value) if key == 'latency' else int(value)
+        return cls(**kwargs)
+
+    def add_domain(self, name, xml=None):
+        if xml is None:
+            xml = ['<domain type="kvm">', '<name>%s</name>' % name]
+            xml += ['<!-- line %d -->' % idx
+                    for idx in range(self.xml_lines)]
+            xml.append('</domain>')
+        self.domains[name] = {'name': name, 'state': 'shut off',
+                              'persistent': 'yes', 'autostart': 'disable',
+                              'xml': xml}
+
+    def domain_xml(self, name):
+        return '\n'.join(self.domains[name]['xml'])
+
+    def network_xml(self, name):
+        return '<network>\n  <name>%s</name>\n</network>' % name
+
+    def pool_xml(self, name):
+        return ('<pool type="dir">\n  <name>%s</name>\n'
+                '  <capacity unit="bytes">1000</capacity>\n'
+                '  <target>\n    <path>/var/lib/%s</path>\n  </target>\n'
+                '</pool>' % (name, name))
+
+    def _domain_command(self, cmd, args):
+        if cmd == 'list':
+            names = [n for n, d in sorted(self.domains.items())
+                     if '--all' in args or d['state'] != 'shut off']
+            return '\n'.join(names) + '\n'
+        name = args[0]
+        dom = self.domains.get(name)
+        if dom is None and cmd != 'define':
+            raise KeyError("failed to get domain '%s'" % name)
+        if cmd == 'dominfo':
+            return ('Id:             %s\nName:           %s\n'
+                    'OS Type:        hvm\nState:          %s\n'
+                    'CPU time:       1.0s\nPersistent:     %s\n'
+                    'Autostart:      %s\n' % (
+                        '1' if dom['state'] == 'running' else '-',
+                        name, dom['state'], dom['persistent'],
+                        dom['autostart']))
+        elif cmd == 'dumpxml':
+            return self.domain_xml(name)
+        elif cmd == 'domstate':
+            return dom['state'] + '\n'
+        elif cmd in ('start', 'create'):
+            dom['state'] = 'running'
+        elif cmd == 'destroy':
+            dom['state'] = 'shut off'
+        elif cmd == 'undefine':
+            del self.domains[name]
+        elif cmd == 'autostart':
+            dom['autostart'] = 'disable' if '--disable' in args else 'enable'
+        return ''
+
+    def _read_xml(self, fname):
+        """
+        Read a defined XML file formatted like virsh dumpxml output.
+        """
+        with open(fname) as fp:
+            return re.sub(r'>\s*<', '>\n<', fp.read()).splitlines()
+
+    def _define_domain(self, fname):
+        xml = self._read_xml(fname)
+        name = re.search(r'<name>(.*)</name>', '\n'.join(xml)).group(1)
+        self.add_domain(name, xml)
+        return ''
+
+    def _network_command(self, cmd, args):
+        if cmd == 'net-list':
+            lines = [' Name    State    Autostart   Persistent',
+                     '-' * 40]
+            for name, net in sorted(self.networks.items()):
+                lines.append(' %s  %s  %s  %s' % (
+                    name, 'active' if net['active'] == 'yes' else 'inactive',
+                    net['autostart'], net['persistent']))
+            return '\n'.join(lines) + '\n'
+        net = self.networks[args[0]]
+        if cmd == 'net-info':
+            return ('Name:           %(name)s\nActive:         %(active)s\n'
+                    'Persistent:     %(persistent)s\n'
+                    'Autostart:      %(autostart)s\n' % net)
+        elif cmd == 'net-dumpxml':
+            return self.network_xml(args[0])
+        elif cmd == 'net-destroy':
+            net['active'] = 'no'
+        elif cmd == 'net-start':
+            net['active'] = 'yes'
+        return ''
+
+    def _pool_command(self, cmd, args):
+        if cmd == 'pool-list':
+            lines = [' Name    State    Autostart', '-' * 30]
+            for name, pool in sorted(self.pools.items()):
+                lines.append(' %s  %s  %s' % (name, pool['state'],
+                                              pool['autostart']))
+            return '\n'.join(lines) + '\n'
+        pool = self.pools[args[0]]
+        if cmd == 'pool-info':
+            return ('Name:           %(name)s\nState:          %(state)s\n'
+                    'Persistent:     %(persistent)s\n'
+                    'Autostart:      %(autostart)s\n'
+                    'Capacity:       10.00 GiB\n'
+                    'Allocation:     1.00 GiB\n'
+                    'Available:      9.00 GiB\n' % pool)
+        elif cmd == 'pool-dumpxml':
+            return self.pool_xml(args[0])
+        elif cmd == 'vol-list':
+            lines = [' Name    Path', '-' * 30]
+            for vol in pool['volumes']:
+                lines.append(' %s  /var/lib/%s/%s' % (vol, args[0], vol))
+            return '\n'.join(lines) + '\n'
+        elif cmd == 'pool-destroy':
+            pool['state'] = 'inactive'
+        elif cmd == 'pool-start':
+            pool['state'] = 'running'
+        return ''
+
+    def _secret_command(self, cmd, args):
+        if cmd == 'secret-list':
+            lines = [' UUID    Usage', '-' * 30]
+            lines += [' %s  ceph client.admin' % uuid for uuid in self.secrets]
+            return '\n'.join(lines) + '\n'
+        elif cmd == 'secret-dumpxml':
+            return ('<secret ephemeral="no" private="yes">\n'
+                    '<uuid>%s</uuid>\n</secret>' % args[0])
+        elif cmd == 'secret-undefine':
+            self.secrets.remove(args[0])
+        elif cmd == 'secret-define':
+            xml = '\n'.join(self._read_xml(args[0]))
+            self.secrets.append(re.search(r'<uuid>(.*)</uuid>', xml).group(1))
+        return ''
+
+    def virsh(self, real_command, cmd, **dargs):
+        if self.latency:
+            time.sleep(self.latency)
+        words = cmd.split()
+        name, args = words[0], words[1:]
+        stdout, stderr, exit_status = '', '', 0
+        with self.lock:
+            try:
+                if name == 'define':
+                    stdout = self._define_domain(args[0])
+                elif name.startswith('net-'):
+                    stdout = self._network_command(name, args)
+                elif name.startswith('pool-') or name == 'vol-list':
+                    stdout = self._pool_command(name, args)
+                elif name.startswith('secret-'):
+                    stdout = self._secret_command(name, args)
+                elif name in ('uri', 'version'):
+                    stdout = 'qemu:///system\n'
+                else:
+                    stdout = self._domain_command(name, args)
+            except (KeyError, IndexError), e:
+                stderr, exit_status = 'error: %s\n' % e, 1
+        return utils.CmdResult(cmd, stdout, stderr, exit_status,
+                               self.latency)
+
+    def run(self, real_run, cmd, *args, **dargs):
+        stdout = ''
+        if cmd.startswith('./run') and '--list-tests' in cmd:
+            stdout = ''.join('%d %s (requires root)\n' % (idx + 1, test)
+                             for idx, test in enumerate(self.tests))
+        elif cmd.startswith('./run'):
+            test = cmd.split('--tests ')[1].split()[0]
+            if test.startswith('unattended_install'):
+                with self.lock:
+                    self.add_domain('virt-tests-vm1')
+            stdout = '(1/1) %s: PASS (0.01 s)\n' % test
+        return utils.CmdResult(cmd, stdout, '', 0, self.latency)
+
+
+class LibvirtCI():
+
+    def parse_args(self):
+        parser = optparse.OptionParser(
+            description='Continuouse integration of '
+            'virt-test libvirt test provider.')
+        parser.add_option('--list', dest='list', action='store_true',
+                          help='List all the test names')
+        parser.add_option('--no', dest='no', action='store', default='',
+                          help='Exclude specified tests.')
+        parser.add_option('--only', dest='only', action='store', default='',
+                          help='Run only for specified tests.')
+        parser.add_option('--no-check', dest='no_check', action='store_true',
+                          help='Disable checking state changes after each test.')
+        parser.add_option('--no-recover', dest='no_recover', action='store_true',
+                          help='Disable recover state changes after each test.')
+        parser.add_option('--connect-uri', dest='connect_uri', action='store',
+                          default='', help='Run tests using specified uri.')
+        parser.add_option('--additional-vms', dest='add_vms', action='store',
+                          default='', help='Additional VMs for testing')
+        parser.add_option('--smoke', dest='smoke', action='store_true',
+                          help='Run one test for each script.')
+        parser.add_option('--slice', dest='slice', action='store',
+                          default='', help='Specify a URL to slice tests.')
+        parser.add_option('--report', dest='report', action='store',
+                          default='xunit_result.xml',
+                          help='Exclude specified tests.')
+        parser.add_option('--white', dest='whitelist', action='store',
+                          default='', help='Whitelist file contains '
+                          'specified test cases to run.')
+        parser.add_option('--black', dest='blacklist', action='store',
+                          default='', help='Blacklist file contains '
+                          'specified test cases to be excluded.')
+        parser.add_option('--config', dest='config', action='store',
+                          default='', help='Specify a custom Cartesian cfg '
+                          'file')
+        parser.add_option('--img-url', dest='img_url', action='store',
+                          default='', help='Specify a URL to a custom image '
+                          'file')
+        parser.add_option('--os-variant', dest='os_variant', action='store',
+                          default='', help='Specify the --os-variant option '
+                          'when doing virt-install.')
+        parser.add_option('--password', dest='password', action='store',
+                          default='', help='Specify a password for logging '
+                          'into guest')
+        parser.add_option('--pull-virt-test', dest='virt_test_pull',
+                          action='store', default='',
+                          help='Merge specified virt-test pull requests. '
+                          'Multiple pull requests are separated by ",", '
                           'example: --pull-virt-test 175,183')
         parser.add_option('--pull-libvirt', dest='libvirt_pull',
                           action='store', default='',
@@ -833,6 +4231,142 @@ class LibvirtCI():
         parser.add_option('--timeout', dest='timeout',
                           action='store', default='1200',
                           help='Maximum run time for one test case')
+        parser.add_option('--workers', dest='workers',
+                          action='store', default='1',
+                          help='Run tests in parallel, each worker with a '
+                          'private libvirtd instance')
+        parser.add_option('--check-every', dest='check_every',
+                          action='store', default='1',
+                          help='Check expensive states (domain, pool, '
+                          'directory) once every N tests')
+        parser.add_option('--check-budget', dest='check_budget',
+                          action='store', default='',
+                          help='Check expensive states when it costs less '
+                          'than this ratio of test run time, e.g. 0.1')
+        parser.add_option('--order-tests', dest='order_tests',
+                          action='store_true', help='Reorder tests to '
+                          'minimize VM state changes and host setups')
+        parser.add_option('--warm-guests', dest='warm_guests',
+                          action='store', default='0',
+                          help='Keep N booted guests saved to disk and '
+                          'restore one for tests starting the VM, unless '
+                          'they work with disks or snapshots. Restored '
+                          'guests run on overlays of their disks')
+        parser.add_option('--profile', dest='profile',
+                          action='store', default='',
+                          help='Save time spent in each CI phase to a JSON '
+                          'file, or CSV file if it ends with .csv')
+        parser.add_option('--virsh-record', dest='virsh_record',
+                          action='store', default='',
+                          help='Record results of virsh and other commands '
+                          'to a fixture file')
+        parser.add_option('--virsh-replay', dest='virsh_replay',
+                          action='store', default='',
+                          help='Replay results of virsh and other commands '
+                          'from a fixture file instead of running them')
+        parser.add_option('--replay-speed', dest='replay_speed',
+                          action='store', default='1',
+                          help='Speed factor of replayed commands, 0 to '
+                          'not wait for recorded durations')
+        parser.add_option('--synthetic-host', dest='synthetic_host',
+                          action='store', default='',
+                          help='Emulate a host instead of running commands, '
+                          'example: --synthetic-host domains=1000,pools=50')
+        parser.add_option('--log-dir', dest='log_dir',
+                          action='store', default='test_logs',
+                          help='Directory to store compressed logs of '
+                          'each test')
+        parser.add_option('--log-excerpt', dest='log_excerpt',
+                          action='store', default='100',
+                          help='Maximum lines of log to put in the report '
+                          'for each test')
+        parser.add_option('--artifact-dir', dest='artifact_dir',
+                          action='store', default='',
+                          help='Directory to pack results and libvirt logs '
+                          'of each test to, e.g. artifacts')
+        parser.add_option('--artifact-budget', dest='artifact_budget',
+                          action='store', default='2048',
+                          help='Maximum size in MB of artifacts to keep')
+        parser.add_option('--events', dest='events',
+                          action='store', default='',
+                          help='Append progress events as JSON lines to a '
+                          'file, or send them to a unix socket with '
+                          'unix:<path>')
+        parser.add_option('--host-baseline', dest='host_baseline',
+                          action='store', default='',
+                          help='File to keep backups of host wide states '
+                          'in, e.g. host_baseline.json, to report drift of '
+                          'the host from them in the next run. It holds '
+                          'contents of watched files and is created with '
+                          'mode 0600')
+        parser.add_option('--repair-drift', dest='repair_drift',
+                          action='store_true',
+                          help='Recover drift of the host from the stored '
+                          'baseline instead of taking a new one')
+        parser.add_option('--watch-files', dest='watch_files',
+                          action='store', default='',
+                          help='Extra files to check for changes after each '
+                          'test, globs separated by ","')
+        parser.add_option('--no-cgroup', dest='no_cgroup',
+                          action='store_true',
+                          help='Disable accounting resources of each test '
+                          'with cgroup v2')
+        parser.add_option('--perf-store', dest='perf_store',
+                          action='store', default='',
+                          help='File to keep durations and libvirt_bench '
+                          'metrics of each run in, e.g. perf_history.jsonl, '
+                          'to report performance regressions')
+        parser.add_option('--perf-window', dest='perf_window',
+                          action='store', default='10',
+                          help='Number of previous runs in the performance '
+                          'baseline')
+        parser.add_option('--perf-sigma', dest='perf_sigma',
+                          action='store', default='3',
+                          help='Standard deviations from the baseline to '
+                          'report a performance regression')
+        parser.add_option('--perf-min-change', dest='perf_min_change',
+                          action='store', default='0.1',
+                          help='Minimum relative change from the baseline '
+                          'to report a performance regression')
+        parser.add_option('--worktree-dir', dest='worktree_dir',
+                          action='store', default='',
+                          help='Directory of shared git mirrors to test PRs '
+                          'in worktrees from, e.g. /var/tmp/virt-test-ci, '
+                          'instead of merging PRs into the checkouts')
+        parser.add_option('--github-cache', dest='github_cache',
+                          action='store', default='',
+                          help='Directory to cache GitHub API responses and '
+                          'patches in, e.g. github_cache')
+        parser.add_option('--github-api', dest='github_api',
+                          action='store', default='https://api.github.com',
+                          help='Base URL of GitHub API')
+        parser.add_option('--github-url', dest='github_url',
+                          action='store', default='https://github.com',
+                          help='Base URL of GitHub to download patches from')
+        parser.add_option('--linked-clones', dest='linked_clones',
+                          action='store_true',
+                          help='Clone additional VMs as qcow2 overlays of '
+                          'a read-only copy of virt-tests-vm1 disks instead '
+                          'of copying disks for each')
+        parser.add_option('--no-bootstrap-cache', dest='no_bootstrap_cache',
+                          action='store_true',
+                          help='Always wipe and bootstrap the data directory')
+        parser.add_option('--history', dest='history',
+                          action='store', default='',
+                          help='File to keep test records across runs in, '
+                          'e.g. ci_history.json')
+        parser.add_option('--min-free-mem', dest='min_free_mem',
+                          action='store', default='1024',
+                          help='Minimum free host memory in MB to keep '
+                          'when starting parallel tests')
+        parser.add_option('--max-load', dest='max_load',
+                          action='store', default='',
+                          help='Maximum host load to start parallel tests, '
+                          'default to number of CPUs')
+        parser.add_option('--max-iowait', dest='max_iowait',
+                          action='store', default='30',
+                          help='Maximum host I/O wait percentage to start '
+                          'parallel tests')
         self.args, self.real_args = parser.parse_args()
 
     def prepare_tests(self, whitelist='whitelist.test',
@@ -986,21 +4520,158 @@ class LibvirtCI():
 
         return class_name, test_name
 
+    def get_test_params(self, tests):
+        """
+        Get Cartesian params of given tests, keyed by test name.
+        """
+        from virttest import cartesian_config
+
+        if self.test_params is not None:
+            return self.test_params
+        if self.args.config:
+            cfg = self.args.config
+        else:
+            cfg = os.path.join(data_dir.get_root_dir(),
+                               'backends', 'libvirt', 'cfg', 'tests.cfg')
+        names = set(tests)
+        params = {}
+        try:
+            parser = cartesian_config.Parser()
+            parser.parse_file(cfg)
+            if self.onlys:
+                parser.only_filter(', '.join(self.onlys))
+            for params_dict in parser.get_dicts():
+                name = params_dict.get('name')
+                if name in names:
+                    params[name] = params_dict
+        except Exception, e:
+            logging.warning('Failed to get params from %s: %s', cfg, e)
+        self.test_params = params
+        return params
+
+    def order_tests(self, tests):
+        """
+        Reorder tests so tests needing the same VM state and the same
+        expensive host setup run back to back.
+
+        Tests are grouped by their setup, the VM state they need and
+        the VM state they leave, and groups are chained so that each
+        group starts from the state the previous one left, if possible.
+        The VM state a test leaves is learned from history when known.
+        Unless --no-recover is given, the VM is recovered to its state
+        after prepare_env() following each test, so that is what every
+        test leaves.
+        """
+        def setup_key(params):
+            setups = []
+            if (params.get('setup_local_nfs') == 'yes' or
+                    params.get('pool_type') == 'netfs' or
+                    params.get('storage_type') == 'nfs'):
+                setups.append('nfs')
+            for key in ['host_selinux', 'selinux_mode']:
+                if params.get(key):
+                    setups.append('selinux:%s' % params[key])
+            return ','.join(setups)
+
+        def vm_states(test, params):
+            if params.get('kill_vm_before_test') == 'yes':
+                need = 'shut off'
+            elif params.get('start_vm') == 'yes':
+                need = 'running'
+            else:
+                need = 'any'
+            if not self.args.no_recover:
+                return need, 'shut off'
+            end = self.history.get(test, 'vm_state')
+            if not end:
+                if params.get('kill_vm') == 'yes':
+                    end = 'shut off'
+                elif params.get('start_vm') == 'yes':
+                    end = 'running'
+                else:
+                    end = need
+            return need, end
+
+        all_params = self.get_test_params(tests)
+        groups = {}
+        first_idx = {}
+        for idx, test in enumerate(tests):
+            params = all_params.get(test, {})
+            need, end = vm_states(test, params)
+            key = (setup_key(params), need, end)
+            groups.setdefault(key, []).append(test)
+            first_idx.setdefault(key, idx)
+
+        ordered = []
+        # VMs are shut off after prepare_env().
+        cur_setup, cur_state = '', 'shut off'
+        while groups:
+            def cost(key):
+                setup, need, end = key
+                return (setup != cur_setup,
+                        need not in ('any', cur_state),
+                        end not in ('any', cur_state),
+                        first_idx[key])
+            key = min(groups, key=cost)
+            ordered += groups.pop(key)
+            cur_setup = key[0]
+            if key[2] != 'any':
+                cur_state = key[2]
+        return ordered
+
     def bootstrap(self):
+        """
+        Bootstrap the data directory unless the cache says it can be
+        reused.
+
+        :return: The cache key to stamp once the generated configs are
+                 edited, or None when the data directory was reused.
+        """
         class _Options(object):
             pass
 
         from virttest import bootstrap
 
+        base_dir = data_dir.get_data_dir()
+        cache = BootstrapCache(self.args)
+        key = cache.key()
+        changed = None
+        if not self.args.no_bootstrap_cache:
+            changed = cache.check(key)
+        if changed is not None and not changed:
+            print 'Reusing bootstrapped data directory'
+            os.chdir(data_dir.get_root_dir())
+            return None
+
         logging.info('Bootstrapping')
         sys.stdout.flush()
-        base_dir = data_dir.get_data_dir()
-        if os.path.exists(base_dir):
-            if os.path.islink(base_dir) or os.path.isfile(base_dir):
-                os.unlink(base_dir)
-            elif os.path.isdir(base_dir):
-                shutil.rmtree(base_dir)
-        os.mkdir(base_dir)
+        if changed:
+            # Only configs were changed, regenerate them in place.
+            print 'Refreshing configs: %s' % ', '.join(
+                os.path.basename(path) for path in changed)
+            for path in changed:
+                if os.path.isfile(path):
+                    os.remove(path)
+        else:
+            image_dir = os.path.join(base_dir, 'images')
+            saved_images = None
+            if (not os.path.islink(base_dir) and
+                    os.path.isdir(image_dir) and
+                    not os.path.islink(image_dir)):
+                # Keep images out of the way of the wipe.
+                saved_images = tempfile.mkdtemp(
+                    prefix='images.', dir=os.path.dirname(
+                        os.path.abspath(base_dir)))
+                os.rmdir(saved_images)
+                os.rename(image_dir, saved_images)
+            if os.path.exists(base_dir):
+                if os.path.islink(base_dir) or os.path.isfile(base_dir):
+                    os.unlink(base_dir)
+                elif os.path.isdir(base_dir):
+                    shutil.rmtree(base_dir)
+            os.mkdir(base_dir)
+            if saved_images:
+                os.rename(saved_images, image_dir)
 
         options = _Options()
         options.vt_type = 'libvirt'
@@ -1015,48 +4686,67 @@ class LibvirtCI():
 
         bootstrap.bootstrap(options=options, interactive=False)
         os.chdir(data_dir.get_root_dir())
+        return key
 
     def prepare_env(self):
         """
         Prepare the environment before all tests.
+
+        Steps run as a dependency graph, so independent ones like
+        restarting services and bootstrapping overlap.
         """
 
         def replace_pattern_in_file(file, search_exp, replace_exp):
+            # Not using fileinput, which redirects stdout of all steps.
             prog = re.compile(search_exp)
-            for line in fileinput.input(file, inplace=1):
-                match = prog.search(line)
-                if match:
-                    line = prog.sub(replace_exp, line)
-                sys.stdout.write(line)
-
-        utils_libvirtd.Libvirtd().restart()
-        service.Factory.create_service("nfs").restart()
-
-        if self.args.password:
+            with open(file) as fp:
+                lines = fp.readlines()
+            with open(file + '.tmp', 'w') as fp:
+                for line in lines:
+                    match = prog.search(line)
+                    if match:
+                        line = prog.sub(replace_exp, line)
+                    fp.write(line)
+            shutil.copymode(file, file + '.tmp')
+            os.rename(file + '.tmp', file)
+
+        def restart_libvirtd():
+            utils_libvirtd.Libvirtd().restart()
+
+        def restart_nfs():
+            service.Factory.create_service("nfs").restart()
+
+        def set_password():
             replace_pattern_in_file(
                 "shared/cfg/guest-os/Linux.cfg",
                 r'password = \S*',
                 r'password = %s' % self.args.password)
 
-        if self.args.os_variant:
+        def set_os_variant():
             replace_pattern_in_file(
                 "shared/cfg/guest-os/Linux/JeOS/19.x86_64.cfg",
                 r'os_variant = \S*',
                 r'os_variant = %s' % self.args.os_variant)
 
-        if self.args.add_vms:
+        def set_vms():
             vms_string = "virt-tests-vm1 " + " ".join(self.args.add_vms.split(','))
             replace_pattern_in_file(
                 "shared/cfg/base.cfg",
                 r'^\s*vms = .*\n',
                 r'vms = %s\n' % vms_string)
 
-        print 'Running bootstrap'
-        sys.stdout.flush()
-        self.bootstrap()
+        def bootstrap():
+            print 'Running bootstrap'
+            sys.stdout.flush()
+            bootstrap_keys.append(self.bootstrap())
 
-        restore_image = True
-        if self.args.img_url:
+        def stamp_bootstrap():
+            # After editing the generated configs, so the next run finds
+            # them as stamped.
+            if bootstrap_keys[0] is not None:
+                BootstrapCache(self.args).save(bootstrap_keys[0])
+
+        def download_image():
             def progress_callback(count, block_size, total_size):
                 #percent = count * block_size * 100 / total_size
                 #sys.stdout.write("\rDownloaded %2.2f%%" % percent)
@@ -1066,70 +4756,154 @@ class LibvirtCI():
             sys.stdout.flush()
             img_dir = os.path.join(
                 os.path.realpath(data_dir.get_data_dir()), 'images/jeos-19-64.qcow2')
-            urllib.urlretrieve(self.args.img_url, img_dir, progress_callback)
-            restore_image = False
+            urllib.urlretrieve(self.args.img_url, img_dir,
+                               progress_callback)
 
-        if self.args.retain_vm:
-            return
-
-        print 'Removing VM\n',  # TODO: use virt-test api remove VM
-        sys.stdout.flush()
-        if self.args.connect_uri:
-            virsh.destroy('virt-tests-vm1',
-                          ignore_status=True,
-                          uri=self.args.connect_uri)
-            virsh.undefine('virt-tests-vm1',
-                           '--snapshots-metadata --managed-save',
-                           ignore_status=True,
-                           uri=self.args.connect_uri)
-        else:
-            virsh.destroy('virt-tests-vm1', ignore_status=True)
-            virsh.undefine('virt-tests-vm1', '--snapshots-metadata', ignore_status=True)
-        if self.args.add_vms:
-            for vm in self.args.add_vms.split(','):
+        def remove_vm():
+            print 'Removing VM'  # TODO: use virt-test api remove VM
+            sys.stdout.flush()
+            if self.args.connect_uri:
+                virsh.destroy('virt-tests-vm1',
+                              ignore_status=True,
+                              uri=self.args.connect_uri)
+                virsh.undefine('virt-tests-vm1',
+                               '--snapshots-metadata --managed-save',
+                               ignore_status=True,
+                               uri=self.args.connect_uri)
+            else:
+                virsh.destroy('virt-tests-vm1', ignore_status=True)
+                virsh.undefine('virt-tests-vm1', '--snapshots-metadata', ignore_status=True)
+            for vm in add_vms:
                 virsh.destroy(vm, ignore_status=True)
                 virsh.undefine(vm, '--snapshots-metadata', ignore_status=True)
 
-        print 'Installing VM',
-        sys.stdout.flush()
-        if 'lxc' in self.args.connect_uri:
-            cmd = 'virt-install --connect=lxc:/// --name virt-tests-vm1 --ram 500 --noautoconsole'
-            try:
-                utils.run(cmd)
-            except error.CmdError, e:
-                raise Exception('   ERROR: Failed to install guest \n %s' % e)
-        else:
-            status, res, err_msg = self.run_test(
-                'unattended_install.import.import.default_install.aio_native',
-                restore_image=restore_image, check=False, recover=False)
-            if 'PASS' not in status:
-                raise Exception('   ERROR: Failed to install guest \n %s' %
-                                res.stderr)
-            virsh.destroy('virt-tests-vm1')
-        if self.args.add_vms:
-            for vm in self.args.add_vms.split(','):
-                cmd = 'virt-clone '
-                if self.args.connect_uri:
-                    cmd += '--connect=%s ' % self.args.connect_uri
-                cmd += '--original=virt-tests-vm1 '
-                cmd += '--name=%s ' % vm
+        def install_vm():
+            print 'Installing VM'
+            sys.stdout.flush()
+            if 'lxc' in self.args.connect_uri:
+                cmd = 'virt-install --connect=lxc:/// --name virt-tests-vm1 --ram 500 --noautoconsole'
+                try:
+                    utils.run(cmd)
+                except error.CmdError, e:
+                    raise Exception('   ERROR: Failed to install guest \n %s' % e)
+            else:
+                status, res, err_msg = self.run_test(
+                    'unattended_install.import.import.default_install.'
+                    'aio_native',
+                    restore_image=not self.args.img_url, check=False,
+                    recover=False)
+                if 'PASS' not in status:
+                    raise Exception('   ERROR: Failed to install guest \n %s' %
+                                    res.stderr)
+                virsh.destroy('virt-tests-vm1')
+
+        def freeze_vm():
+            # Later tests write to disks of virt-tests-vm1, so linked
+            # clones are backed by read-only copies of them.
+            res = virsh.dumpxml('virt-tests-vm1', extra='--inactive',
+                                uri=self.args.connect_uri or None,
+                                ignore_status=True)
+            if res.exit_status:
+                raise Exception('Failed to dumpxml virt-tests-vm1:\n%s'
+                                % res)
+            paths = re.findall(r"<source file=['\"]([^'\"]+)['\"]",
+                               res.stdout)
+            for path in sorted(set(paths), key=paths.index):
+                frozen = os.path.join(
+                    os.path.dirname(path),
+                    'frozen-%s' % os.path.basename(path))
+                if os.path.exists(frozen):
+                    os.remove(frozen)
+                utils.run('cp --sparse=always %s %s' % (path, frozen))
+                os.chmod(frozen, 0444)
+                frozen_disks.append((path, frozen))
+
+        def clone_vm(vm):
+            cmd = 'virt-clone '
+            if self.args.connect_uri:
+                cmd += '--connect=%s ' % self.args.connect_uri
+            cmd += '--original=virt-tests-vm1 '
+            cmd += '--name=%s ' % vm
+            if self.args.linked_clones:
+                for path, frozen in frozen_disks:
+                    overlay = os.path.join(
+                        os.path.dirname(path),
+                        '%s-%s' % (vm, os.path.basename(path)))
+                    create_overlay(frozen, overlay)
+                    cmd += '--file=%s ' % overlay
+                cmd += '--preserve-data'
+            else:
                 cmd += '--auto-clone'
-                utils.run(cmd)
+            utils.run(cmd)
 
-    def run_test(self, test, restore_image=False, check=True, recover=True):
+        add_vms = []
+        if self.args.add_vms:
+            add_vms = self.args.add_vms.split(',')
+        frozen_disks = []
+        bootstrap_keys = []
+
+        graph = StepGraph(self.profiler)
+        graph.add('restart libvirtd', restart_libvirtd)
+        graph.add('restart nfs', restart_nfs)
+        graph.add('bootstrap', bootstrap)
+        if self.args.password:
+            graph.add('set password', set_password, ['bootstrap'])
+        if self.args.os_variant:
+            graph.add('set os variant', set_os_variant, ['bootstrap'])
+        if self.args.add_vms:
+            graph.add('set vms', set_vms, ['bootstrap'])
+        graph.add('stamp bootstrap', stamp_bootstrap,
+                  ['bootstrap', 'set password', 'set os variant', 'set vms'])
+        if self.args.img_url:
+            graph.add('download image', download_image, ['bootstrap'])
+        if not self.args.retain_vm:
+            graph.add('remove vm', remove_vm, ['restart libvirtd'])
+            graph.add('install vm', install_vm,
+                      ['remove vm', 'stamp bootstrap', 'download image'])
+            if add_vms and self.args.linked_clones:
+                graph.add('freeze vm', freeze_vm, ['install vm'])
+            for vm in add_vms:
+                graph.add('clone %s' % vm, lambda vm=vm: clone_vm(vm),
+                          ['install vm', 'freeze vm'])
+        try:
+            graph.run()
+        finally:
+            path = graph.critical_path()
+            if path:
+                print 'Critical path of preparation: %s' % ' -> '.join(
+                    '%s (%.1f s)' % step for step in path)
+                sys.stdout.flush()
+
+    def run_test(self, test, restore_image=False, check=True, recover=True,
+                 worker=None, rerun=False):
         """
-        Run a specific test.
+        Run a specific test. Logs and cgroups of re-runs are named
+        apart from the first run.
         """
+        if worker is None:
+            worker = self.main_worker
         img_str = '' if restore_image else 'k'
         down_str = '' if restore_image else '--no-downloads'
         cmd = './run -v%st libvirt --keep-image-between-tests %s --tests %s' % (
             img_str, down_str, test)
-        if self.args.connect_uri:
-            cmd += ' --connect-uri %s' % self.args.connect_uri
+        if worker.uri:
+            cmd += ' --connect-uri "%s"' % worker.uri
+        if worker.instance is not None:
+            cmd = worker.instance.wrap_run(cmd)
         status = 'INVALID'
+        if rerun:
+            log_writer = self.log_store.open(test, '.rerun')
+            usage = self.cgroups.start(worker, '%s-rerun' % worker.name)
+        else:
+            log_writer = self.log_store.open(test)
+            usage = self.cgroups.start(worker)
         try:
-            res = utils.run(cmd, timeout=int(self.args.timeout),
-                            ignore_status=True)
+            with self.profiler.phase('run', test):
+                res = utils.run(self.cgroups.wrap(usage, cmd),
+                                timeout=int(self.args.timeout),
+                                ignore_status=True,
+                                stdout_tee=log_writer,
+                                stderr_tee=log_writer)
             lines = res.stdout.splitlines()
             for line in lines:
                 if line.startswith('(1/1)'):
@@ -1139,8 +4913,14 @@ class LibvirtCI():
             status = 'TIMEOUT'
             res.duration = int(self.args.timeout)
         except Exception, e:
+            log_writer.close()
             print "Exception when parsing stdout.\n%s" % res
             raise e
+        finally:
+            usage = self.cgroups.finish(usage)
+        self.log_store.finish(log_writer, res)
+        res.log_file = log_writer.path
+        res.usage = usage
 
         os.chdir(data_dir.get_root_dir())  # Check PWD
 
@@ -1148,8 +4928,30 @@ class LibvirtCI():
 
         if check:
             diff = False
-            for state in self.states:
-                diffmsg = state.check(recover=recover)
+            planner = RecoveryPlanner()
+            bisects = []
+            for state in worker.states:
+                with self.profiler.phase(
+                        'check:%s' % state.__class__.__name__, test):
+                    diffmsg = self.check_state(worker, state, test,
+                                               res.duration, recover,
+                                               planner=planner,
+                                               bisects=bisects)
+                if diffmsg:
+                    if not diff:
+                        diff = True
+                        status += ' DIFF'
+                    for line in diffmsg:
+                        err_msg.append('   DIFF|%s' % line)
+            with self.profiler.phase('recover', test):
+                failures = planner.run()
+            for state, lines in failures.items():
+                for line in lines:
+                    err_msg.append('   DIFF|%s %s' % (state.name, line))
+            # Bisect only once all states are checked and recovered.
+            for state, window, diffmsg in bisects:
+                diffmsg = self.blame_diff(worker, state, test, window,
+                                          diffmsg, recover)
                 if diffmsg:
                     if not diff:
                         diff = True
@@ -1157,7 +4959,11 @@ class LibvirtCI():
                     for line in diffmsg:
                         err_msg.append('   DIFF|%s' % line)
 
-        print 'Result: %s %.2f s' % (status, res.duration)
+        if worker.instance is None:
+            print 'Result: %s %.2f s' % (status, res.duration)
+        else:
+            print '[%s] %s Result: %s %.2f s' % (worker.name, test, status,
+                                                res.duration)
 
         if 'FAIL' in status or 'ERROR' in status:
             for line in res.stderr.splitlines():
@@ -1172,28 +4978,136 @@ class LibvirtCI():
         sys.stdout.flush()
         return status, res, err_msg
 
-    def prepare_repos(self):
+    def check_state(self, worker, state, test, duration, recover,
+                    flush=False, planner=None, bisects=None):
+        """
+        Check a state after a test if it's due. When changes are found
+        for a window of several tests, find the test causing them and
+        queue the diff to be reported for it, or add the state, window
+        and diff to _bisects_ to do it later with blame_diff().
+
+        Return diff messages belonging to _test_.
+        """
+        budget = None
+        if self.args.check_budget:
+            budget = float(self.args.check_budget)
+        if not flush and not state.sample(test, duration,
+                                          every=int(self.args.check_every),
+                                          budget=budget):
+            return []
+
+        window = state.window
+        diffmsg = state.timed_check(recover=recover, planner=planner)
+        if not diffmsg or len(window) == 1:
+            return diffmsg
+        if bisects is not None:
+            bisects.append((state, window, diffmsg))
+            return []
+        return self.blame_diff(worker, state, test, window, diffmsg, recover)
+
+    def blame_diff(self, worker, state, test, window, diffmsg, recover):
+        """
+        Find the test in _window_ causing changes of a state, and queue
+        the diff to be reported for it. The state must be recovered.
+
+        Return diff messages belonging to _test_.
+        """
+        culprit, culprit_msg = None, None
+        if recover:
+            if self.scheduler is not None:
+                # Re-runs take their own slots, don't wait for ours.
+                self.scheduler.release(test)
+            culprit, culprit_msg = self.bisect_diff(worker, state, window)
+        if culprit is None:
+            culprit = window[-1]
+            culprit_msg = (['Changes found after tests: %s' %
+                            ', '.join(window)] + diffmsg)
+        if culprit == test:
+            return culprit_msg
+        worker.late_diffs.append((culprit, culprit_msg))
+        return []
+
+    def bisect_diff(self, worker, state, window):
+        """
+        Find the test causing changes of a state in a window of tests
+        by re-running halves of the window, starting from a recovered
+        state.
+
+        Return the test and its diff message, or (None, None) if changes
+        can not be reproduced.
+        """
+        def rerun(tests):
+            for test in tests:
+                print '   Re-running %s for %s state' % (test, state.name)
+                sys.stdout.flush()
+                if self.scheduler is not None:
+                    self.scheduler.acquire(test)
+                try:
+                    self.prepare_test(test, worker=worker)
+                    self.run_test(test, check=False, worker=worker,
+                                  rerun=True)
+                finally:
+                    if self.scheduler is not None:
+                        self.scheduler.release(test)
+
+        print '   Bisecting %d tests for %s state changes' % (len(window),
+                                                              state.name)
+        # Other states may hold changes not checked yet, only undo those
+        # of re-run tests.
+        snapshots = [(other, other.snapshot()) for other in worker.states
+                     if other is not state]
+        with self.profiler.phase('bisect:%s' % state.__class__.__name__):
+            while len(window) > 1:
+                half = window[:len(window) // 2]
+                rerun(half)
+                if state.check(recover=True):
+                    window = half
+                else:
+                    window = window[len(half):]
+            rerun(window)
+            diffmsg = state.check(recover=True)
+
+            for other, snapshot in snapshots:
+                for line in other.revert(snapshot):
+                    print '   Re-run changes of %s: %s' % (other.name, line)
+        if diffmsg:
+            return window[0], diffmsg
+        return None, None
+
+    def prepare_repos(self, repo_dirs=None):
         """
         Prepare repos for the tests.
+
+        PRs are merged into a test branch of the checkouts, or into
+        detached worktrees when _repo_dirs_ maps repo names to them.
         """
         def merge_pulls(repo_name, pull_nos):
-            branch_name = ','.join(pull_nos)
-            cmd = 'git checkout -b %s' % branch_name
-            res = utils.run(cmd, ignore_status=True)
-            if res.exit_status:
-                print res
-                raise Exception('Failed to create branch %s' % branch_name)
-
-            for pull_no in pull_nos:
-                if pr_open(repo_name, pull_no):
-                    patch_url = ('https://github.com/autotest'
-                                 '/%s/pull/%s.patch' % (repo_name, pull_no))
-                    patch_file = "/tmp/%s.patch" % pull_no
-                    with open(patch_file, 'w') as pf:
-                        pf.write(urllib2.urlopen(patch_url).read())
-                    with open(patch_file, 'r') as pf:
-                        if not pf.read().strip():
-                            print 'WARING: empty content for PR #%s' % pull_no
+            def get_patch(pull_no):
+                if fetcher.pr_open(repo_name, pull_no):
+                    return fetcher.patch(repo_name, pull_no)
+                return None
+
+            pull_nos = sorted(pull_nos)
+            patches = fetcher.map(get_patch, pull_nos)
+
+            branch_name = None
+            if worktrees is None:
+                branch_name = ','.join(pull_nos)
+                cmd = 'git checkout -b %s' % branch_name
+                res = utils.run(cmd, ignore_status=True)
+                if res.exit_status:
+                    print res
+                    raise Exception('Failed to create branch %s' %
+                                    branch_name)
+
+            for pull_no, patch in zip(pull_nos, patches):
+                if patch is not None:
+                    fd, patch_file = tempfile.mkstemp(
+                        prefix='%s-' % pull_no, suffix='.patch')
+                    with os.fdopen(fd, 'w') as pf:
+                        pf.write(patch)
+                    if not patch.strip():
+                        print 'WARING: empty content for PR #%s' % pull_no
                     try:
                         print 'Patching %s PR #%s' % (repo_name, pull_no)
                         cmd = 'git am -3 %s' % patch_file
@@ -1224,45 +5138,46 @@ class LibvirtCI():
             res |= set(match)
             return res
 
-        def pr_open(repo_name, pr_number):
-            oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
-                     '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
-            issues_url = 'https://api.github.com/repos/autotest/%s/issues/' % repo_name
-            issue_url = issues_url + pr_number + oauth
-            issue_u = urllib2.urlopen(issue_url)
-            issue = json.load(issue_u)
-            return issue['state'] == 'open'
-
-        def libvirt_pr_dep(pr_numbers):
-            oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
-                     '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
+        def pr_dep(pr_number):
             dep = set()
-            for pr_number in pr_numbers:
-                # Find PR's first comment for dependencies.
-                issues_url = 'https://api.github.com/repos/autotest/tp-libvirt/issues/'
-                issue_url = issues_url + pr_number + oauth
-                issue_u = urllib2.urlopen(issue_url)
-                issue = json.load(issue_u)
-                for line in issue['body'].splitlines():
+            # Find PR's first comment for dependencies.
+            issue = fetcher.issue('tp-libvirt', pr_number)
+            for line in (issue['body'] or '').splitlines():
+                dep |= search_dep(line)
+
+            # Find PR's other comments for dependencies.
+            for comment in fetcher.comments('tp-libvirt', pr_number):
+                for line in comment['body'].splitlines():
                     dep |= search_dep(line)
+            return dep
 
-                # Find PR's other comments for dependencies.
-                comments_url = issues_url + '%s/comments' % pr_number + oauth
-                comments_u = urllib2.urlopen(comments_url)
-                comments = json.load(comments_u)
-                for comment in comments:
-                    for line in comment['body'].splitlines():
-                        dep |= search_dep(line)
+        def libvirt_pr_dep(pr_numbers):
+            dep = set()
+            for pr_dep_set in fetcher.map(pr_dep, pr_numbers):
+                dep |= pr_dep_set
 
             # Remove closed dependences:
-            pruned_dep = set()
-            for pr_number in dep:
-                if pr_open('virt-test', pr_number):
-                    pruned_dep.add(pr_number)
+            dep = sorted(dep)
+            states = fetcher.map(
+                lambda pr_number: fetcher.pr_open('virt-test', pr_number),
+                dep)
+            return set(pr_number for pr_number, is_open in zip(dep, states)
+                       if is_open)
 
-            return pruned_dep
+        fetcher = GitHubFetcher(self.args.github_cache,
+                                api_url=self.args.github_api,
+                                web_url=self.args.github_url)
 
         self.virt_branch_name, self.libvirt_branch_name = None, None
+        worktrees = repo_dirs
+        if repo_dirs is None:
+            repo_dirs = {
+                'virt-test': data_dir.get_root_dir(),
+                'tp-libvirt': data_dir.get_test_provider_dir(
+                    'io-github-autotest-libvirt'),
+            }
+        # PRs were merged by the run which started this one in a worktree.
+        merged = bool(os.environ.get('VIRT_TEST_CI_WORKTREE'))
 
         libvirt_pulls = set()
         virt_test_pulls = set()
@@ -1270,27 +5185,115 @@ class LibvirtCI():
         if self.args.libvirt_pull:
             libvirt_pulls = set(self.args.libvirt_pull.split(','))
 
-        if self.args.with_dependence:
+        if self.args.with_dependence and not merged:
             virt_test_pulls = libvirt_pr_dep(libvirt_pulls)
 
         if self.args.virt_test_pull:
             virt_test_pulls |= set(self.args.virt_test_pull.split(','))
 
         if virt_test_pulls:
-            os.chdir(data_dir.get_root_dir())
-            self.virt_branch_name = merge_pulls("virt-test", virt_test_pulls)
+            os.chdir(repo_dirs['virt-test'])
+            if not merged:
+                self.virt_branch_name = merge_pulls("virt-test",
+                                                    virt_test_pulls)
             if self.args.only_change:
                 self.virt_file_changed = file_changed("virt-test")
 
         if libvirt_pulls:
-            os.chdir(data_dir.get_test_provider_dir(
-                'io-github-autotest-libvirt'))
-            self.libvirt_branch_name = merge_pulls("tp-libvirt", libvirt_pulls)
+            os.chdir(repo_dirs['tp-libvirt'])
+            if not merged:
+                self.libvirt_branch_name = merge_pulls("tp-libvirt",
+                                                       libvirt_pulls)
             if self.args.only_change:
                 self.libvirt_file_changed = file_changed("tp-libvirt")
 
         os.chdir(data_dir.get_root_dir())
 
+    def copy_local_changes(self, src_dir, dst_dir):
+        """
+        Apply uncommitted changes of a checkout to a worktree, and copy
+        its test list files, which are not tracked.
+        """
+        res = utils.run('cd %s && git diff --binary HEAD' % src_dir)
+        if res.stdout:
+            patch_file = tempfile.NamedTemporaryFile(delete=False)
+            patch_file.write(res.stdout)
+            patch_file.close()
+            try:
+                utils.run('cd %s && git apply %s' % (dst_dir,
+                                                      patch_file.name))
+            finally:
+                os.remove(patch_file.name)
+        for path in glob.glob(os.path.join(src_dir, '*.test')):
+            shutil.copy(path, dst_dir)
+
+    def run_in_worktree(self):
+        """
+        Merge PRs into worktrees of virt-test and tp-libvirt created
+        from shared mirrors, and run the CI from there, leaving the
+        checkouts untouched.
+
+        Return the exit status of the run.
+        """
+        root_dir = data_dir.get_root_dir()
+        provider_dir = data_dir.get_test_provider_dir(
+            'io-github-autotest-libvirt')
+        work_dir = os.path.abspath(self.args.worktree_dir)
+        mirrors = {'virt-test': GitMirror(work_dir, 'virt-test'),
+                   'tp-libvirt': GitMirror(work_dir, 'tp-libvirt')}
+
+        # Remove worktrees left by crashed runs.
+        for fname in os.listdir(work_dir):
+            pid_file = os.path.join(work_dir, fname, 'pid')
+            if not fname.startswith('run-') or not os.path.isfile(pid_file):
+                continue
+            with open(pid_file) as fp:
+                pid = int(fp.read() or 0)
+            if not os.path.exists('/proc/%d' % pid):
+                shutil.rmtree(os.path.join(work_dir, fname),
+                              ignore_errors=True)
+        for mirror in mirrors.values():
+            mirror.prune()
+
+        run_dir = tempfile.mkdtemp(prefix='run-', dir=work_dir)
+        with open(os.path.join(run_dir, 'pid'), 'w') as fp:
+            fp.write(str(os.getpid()))
+        repo_dirs = {'virt-test': os.path.join(run_dir, 'virt-test')}
+        if provider_dir.startswith(root_dir.rstrip('/') + '/'):
+            # Providers are downloaded into virt-test, keep them there.
+            repo_dirs['tp-libvirt'] = os.path.join(
+                repo_dirs['virt-test'],
+                os.path.relpath(provider_dir, root_dir))
+        else:
+            repo_dirs['tp-libvirt'] = os.path.join(run_dir, 'tp-libvirt')
+        try:
+            for name, src_dir in [('virt-test', root_dir),
+                                  ('tp-libvirt', provider_dir)]:
+                commit = mirrors[name].update(src_dir)
+                parent_dir = os.path.dirname(repo_dirs[name])
+                if not os.path.isdir(parent_dir):
+                    os.makedirs(parent_dir)
+                mirrors[name].add_worktree(repo_dirs[name], commit)
+                self.copy_local_changes(src_dir, repo_dirs[name])
+            self.prepare_repos(repo_dirs)
+
+            # Run the script from the worktree to import its virttest.
+            script = os.path.join(repo_dirs['virt-test'], 'ci.py')
+            if not os.path.exists(script):
+                shutil.copy(os.path.abspath(__file__), script)
+            report = self.args.report
+            if not os.path.isabs(report):
+                report = os.path.join(root_dir, report)
+            env = dict(os.environ, VIRT_TEST_CI_WORKTREE=run_dir)
+            return subprocess.call(
+                [sys.executable, script] + sys.argv[1:] +
+                ['--report', report], env=env, cwd=self.start_dir)
+        finally:
+            os.chdir(self.start_dir)
+            shutil.rmtree(run_dir, ignore_errors=True)
+            for mirror in mirrors.values():
+                mirror.prune()
+
     def restore_repos(self):
         """
         Checkout master branch and remove test branch.
@@ -1315,62 +5318,397 @@ class LibvirtCI():
             restore_repo(self.libvirt_branch_name)
         os.chdir(data_dir.get_root_dir())
 
-    def prepare_test(self, test):
+    def prepare_test(self, test, worker=None):
         """
         Action to perform before a test
         """
-        from virttest import virsh
-        res = virsh.dumpxml('virt-tests-vm1',
-                            ignore_status=True,
-                            uri=self.args.connect_uri)
-        if not res.exit_status:
-            domxml = res.stdout
-            fname = '/var/lib/libvirt/qemu/nvram/virt-tests-vm1_VARS.fd'
-            if not os.path.exists(fname) and fname in domxml:
-                logging.warning(
-                    'nvram in XML, but file %s do not exists. '
-                    'Removing nvram line. XML:\n%s' % (fname, domxml))
-                domxml = re.sub('<nvram>.*</nvram>', '', domxml)
-                virsh.destroy('virt-tests-vm1',
-                              ignore_status=True,
-                              uri=self.args.connect_uri)
-                virsh.undefine('virt-tests-vm1',
-                               '--snapshots-metadata --managed-save',
-                               ignore_status=True,
-                               uri=self.args.connect_uri)
+        if worker is None:
+            worker = self.main_worker
+        digest = None
+        for state in worker.states:
+            if isinstance(state, DomainState):
+                digest = state.digest('virt-tests-vm1')
+        self.pre_test_checks.run(worker, digest)
+
+        if (worker.warm_pool is not None and
+                not re.match(WarmPool.cold_re, test)):
+            params = (self.test_params or {}).get(test, {})
+            if (params.get('start_vm') == 'yes' and
+                    params.get('kill_vm_before_test') != 'yes'):
+                res = virsh.domstate('virt-tests-vm1', uri=worker.uri,
+                                     ignore_status=True)
+                if res.stdout.strip() == 'shut off':
+                    worker.warm_pool.restore()
+
+    def fix_nvram(self, worker, domxml):
+        """
+        Remove nvram from virt-tests-vm1 when its file is missing.
+        Return True when the domain was redefined.
+        """
+        fname = '/var/lib/libvirt/qemu/nvram/virt-tests-vm1_VARS.fd'
+        path = fname
+        if worker.instance is not None:
+            path = worker.instance.resolve(fname)
+        if not os.path.exists(path) and fname in domxml:
+            logging.warning(
+                'nvram in XML, but file %s do not exists. '
+                'Removing nvram line. XML:\n%s' % (path, domxml))
+            domxml = re.sub('<nvram>.*</nvram>', '', domxml)
+            virsh.destroy('virt-tests-vm1',
+                          ignore_status=True,
+                          uri=worker.uri)
+            virsh.undefine('virt-tests-vm1',
+                           '--snapshots-metadata --managed-save',
+                           ignore_status=True,
+                           uri=worker.uri)
 
-                xml_path = '/tmp/virt-test-ci.xml'
-                with open(xml_path, 'w') as fp:
-                    fp.write(domxml)
-                res = virsh.define(xml_path)
-                if res.exit_status:
-                    logging.error('Define command result:\n%s', res)
-                    raise Exception('Failed to define domain for XML:\n%s' % domxml)
-                try:
-                    os.remove(xml_path)
-                except OSError:
-                    pass
-        else:
-            logging.warning('Failed to dumpxml from virt-tests-vm1\n%s', res)
+            xml_path = '/tmp/virt-test-ci-%s.xml' % worker.name
+            with open(xml_path, 'w') as fp:
+                fp.write(domxml)
+            res = virsh.define(xml_path, uri=worker.uri)
+            if res.exit_status:
+                logging.error('Define command result:\n%s', res)
+                raise Exception('Failed to define domain for XML:\n%s' % domxml)
+            try:
+                os.remove(xml_path)
+            except OSError:
+                pass
+            return True
+        return False
+
+    def create_workers(self):
+        """
+        Create test workers. A single worker uses the system libvirtd or
+        --connect-uri, more workers each get a private libvirtd instance.
+        """
+        watch_files = [p for p in self.args.watch_files.split(',') if p]
+        self.main_worker = Worker('main', uri=self.args.connect_uri,
+                                  watch_files=watch_files)
+        workers = int(self.args.workers)
+        if workers <= 1:
+            self.workers = [self.main_worker]
+            self.host_states = []
+            return
+        if self.args.connect_uri:
+            raise Exception('--workers can not be used with --connect-uri')
+        self.workers = []
+        for idx in range(workers):
+            name = 'worker-%d' % (idx + 1)
+            self.workers.append(Worker(
+                name, instance=LibvirtdInstance(name, idx + 1)))
+        # Host wide states are shared by all workers, so they are only
+        # checked once after all tests finished.
+        self.host_states = [FileState(patterns=watch_files), ServiceState(),
+                            DirState(), MountState(), LinkState(),
+                            LoopState(), DeviceMapperState(),
+                            FirewallState(), ModuleState()]
+
+    def backup_states(self):
+        """
+        Backup states of all workers and the host.
+
+        Host wide states stored by an earlier run on this host are
+        checked against the host instead, and only backed up again when
+        they drifted, unless --repair-drift recovered them.
+        """
+        baseline = self.baseline
+        host_states = list(self.host_states)
+        if len(self.workers) == 1:
+            host_states += self.workers[0].states
+        host_states = [state for state in host_states if state.persistent]
+        if not self.args.retain_vm:
+            # The VM was just installed again.
+            host_states = [state for state in host_states
+                           if not isinstance(state, DomainState)]
+        fingerprint = None
+        stored = None
+        if self.args.host_baseline and host_states:
+            fingerprint = baseline.fingerprint(self.workers)
+            stored = baseline.load(fingerprint)
+
+        changed = stored is None
+        states = list(self.host_states)
+        for worker in self.workers:
+            states += worker.states
+        for state in states:
+            class_name = state.__class__.__name__
+            with self.profiler.phase('backup:%s' % class_name):
+                if state not in host_states:
+                    state.backup()
+                    continue
+                if stored is None or class_name not in stored:
+                    state.backup()
+                    changed = True
+                    continue
+                state.load(stored[class_name])
+                diff_msg = state.check(recover=self.args.repair_drift)
+                if not diff_msg:
+                    continue
+                print 'Host drifted from the baseline:'
+                for line in diff_msg:
+                    print '   DRIFT|%s' % line
+                if self.args.repair_drift and not state.check():
+                    continue
+                state.backup()
+                changed = True
+        if fingerprint is not None and changed:
+            baseline.save(fingerprint, host_states)
+
+    def prepare_workers(self):
+        """
+        Start private libvirtd instances and define test VMs in them.
+        """
+        vm_names = ['virt-tests-vm1']
+        if self.args.add_vms:
+            vm_names += self.args.add_vms.split(',')
+        for worker in self.workers:
+            if worker.instance is None:
+                continue
+            print 'Starting libvirtd instance %s' % worker.name
+            sys.stdout.flush()
+            worker.instance.setup()
+            if not worker.instance.start():
+                raise Exception('Failed to start libvirtd instance %s' %
+                                worker.name)
+            worker.provision(vm_names)
+
+        warm_guests = int(self.args.warm_guests)
+        if warm_guests and 'lxc' not in self.args.connect_uri:
+            for worker in self.workers:
+                print 'Preparing warm guests for %s' % worker.name
+                sys.stdout.flush()
+                # The JeOS guest password is 123456 unless --password
+                # changed it.
+                worker.warm_pool = WarmPool(
+                    'virt-tests-vm1',
+                    os.path.join('/var/lib/virt-test-ci', worker.name),
+                    size=warm_guests, uri=worker.uri,
+                    password=self.args.password or '123456')
+                worker.warm_pool.setup()
+
+    def run_worker(self, worker, test_queue, total, report):
+        """
+        Run tests from a queue until it's empty.
+        """
+        while True:
+            try:
+                idx, test = test_queue.get_nowait()
+            except Queue.Empty:
+                break
+            short_name = test.split('.', 2)[2]
+            if worker.instance is None:
+                print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
+                                          total, short_name),
+            else:
+                print '%s (%d/%d) [%s] %s' % (time.strftime('%X'), idx + 1,
+                                              total, worker.name, short_name)
+            sys.stdout.flush()
+
+            if self.scheduler is not None:
+                self.scheduler.acquire(test)
+            self.events.emit('test_started', test=test, worker=worker.name,
+                             index=idx + 1, total=total)
+            if self.artifacts is not None:
+                marks = self.artifacts.mark(worker)
+            try:
+                with self.profiler.phase('prepare_test', test):
+                    self.prepare_test(test, worker=worker)
+
+                status, res, err_msg = self.run_test(
+                    test,
+                    check=not self.args.no_check,
+                    recover=not self.args.no_recover,
+                    worker=worker)
+            except Exception, e:
+                self.events.emit('test_finished', test=test,
+                                 worker=worker.name, status='INVALID',
+                                 error=str(e)[:200])
+                if worker.instance is None:
+                    raise
+                traceback.print_exc()
+                self.report_writer.submit(self.report_error, test,
+                                          traceback.format_exc())
+                continue
+            finally:
+                if self.scheduler is not None:
+                    self.scheduler.release(test)
+
+            if self.artifacts is not None:
+                self.artifacts.submit(test, worker, res, marks)
+            self.history.record(test, duration=res.duration,
+                                status=status.split()[0])
+            self.perf.record(test, status, res)
+            if res.usage is not None and res.duration:
+                self.history.record(
+                    test,
+                    mem=res.usage['mem'] + res.usage['qemu_mem'],
+                    cpu=round((res.usage['cpu'] + res.usage['qemu_cpu']) /
+                              res.duration, 2),
+                    io=res.usage['io_read'] + res.usage['io_write'])
+            self.record_vm_state(worker, test)
+            self.events.test_finished(test, worker, status, res, err_msg)
+
+            late_diffs, worker.late_diffs = worker.late_diffs, []
+            self.report_writer.submit(self.report_result, test, status,
+                                      res, err_msg, late_diffs)
+
+        # Check states still having unchecked tests.
+        if not self.args.no_check:
+            for state in worker.states:
+                if not state.window:
+                    continue
+                last_test = state.window[-1]
+                diffmsg = self.check_state(
+                    worker, state, last_test, 0,
+                    not self.args.no_recover, flush=True)
+                if diffmsg:
+                    worker.late_diffs.append((last_test, diffmsg))
+            late_diffs, worker.late_diffs = worker.late_diffs, []
+            self.report_writer.submit(self.report_late_diffs, late_diffs)
+
+    def record_vm_state(self, worker, test):
+        """
+        Record the state a test left virt-tests-vm1 in, if the domain
+        state was just captured and not recovered.
+        """
+        if not self.args.no_recover:
+            return
+        for state in worker.states:
+            if isinstance(state, DomainState) and not state.window:
+                dom = getattr(state, 'current_state', {}).get(
+                    'virt-tests-vm1')
+                if dom is not None:
+                    self.history.record(test, vm_state=dom['state'])
+
+    def report_result(self, report, test, status, res, err_msg, late_diffs):
+        """
+        Add a test result to the report. Run by the report writer.
+        """
+        class_name, test_name = self.split_name(test)
+        with self.profiler.phase('report:update', test):
+            log = 'Full log: %s\n' % res.log_file
+            if res.usage is not None:
+                log += ('Resources: CPU %(cpu).1f s, peak memory %(mem)d kB, '
+                        'I/O read %(io_read)d B write %(io_write)d B, '
+                        'pressure stall CPU %(psi_cpu).1f s memory '
+                        '%(psi_mem).1f s I/O %(psi_io).1f s, qemu CPU '
+                        '%(qemu_cpu).1f s memory %(qemu_mem)d kB\n' %
+                        res.usage)
+            log += self.log_store.excerpt(res.stderr)
+            report.update(test_name, class_name, status,
+                          log, err_msg, res.duration)
+            self.report_late_diffs(report, late_diffs)
+        self.history.save()
+
+    def report_error(self, report, test, trace):
+        """
+        Add a test which couldn't be run to the report as an error.
+        """
+        class_name, test_name = self.split_name(test)
+        report.update(test_name, class_name, 'ERROR', trace,
+                      trace.splitlines()[-1:], 0)
+
+    def report_host_diffs(self, report, diffmsg):
+        """
+        Add changes of host wide states found after all tests to the
+        report, as they can't be told apart by test.
+        """
+        report.update('host_states', 'host', 'DIFF', '\n'.join(diffmsg),
+                      ['   DIFF|%s' % line for line in diffmsg], 0)
+
+    def report_late_diffs(self, report, late_diffs):
+        """
+        Add state changes found by sampled checks to the tests causing
+        them.
+        """
+        for test, diffmsg in late_diffs:
+            self.events.emit('late_diff', test=test, diff_summary=diffmsg[:5],
+                             diff_lines=len(diffmsg))
+            print 'DIFF of %s:' % test
+            for line in diffmsg:
+                print '   DIFF|%s' % line
+            class_name, test_name = self.split_name(test)
+            report.add_diff(test_name, class_name,
+                            ['   DIFF|%s' % line for line in diffmsg])
+
+    def report_performance(self, report):
+        """
+        Add libvirt_bench metrics and performance regressions of this
+        run as a 'performance' test suite. Run by the report writer.
+        """
+        for test, metric, value, mean, stdev, regressed in \
+                self.perf.compare():
+            if not regressed and metric == 'duration':
+                continue
+            _, test_name = self.split_name(test)
+            msg = '%s of %s is %.4g, baseline %.4g +- %.4g' % (
+                metric, test_name, value, mean, stdev)
+            if regressed:
+                print 'PERF REGRESSION: %s' % msg
+            report.update('%s.%s' % (test_name, metric), 'performance',
+                          'FAIL' if regressed else 'PASS', msg,
+                          [msg] if regressed else [],
+                          value if metric == 'duration' else 0)
+        self.perf.save()
 
     def run(self):
         """
         Run continuous integrate for virt-test test cases.
         """
         self.parse_args()
+        self.start_dir = os.getcwd()
+        if (self.args.worktree_dir and
+                (self.args.virt_test_pull or self.args.libvirt_pull) and
+                not os.environ.get('VIRT_TEST_CI_WORKTREE')):
+            sys.exit(self.run_in_worktree())
+        self.workers = []
+        self.host_states = []
+        self.history = History(self.args.history)
+        self.baseline = HostBaseline(self.args.host_baseline, self.args)
+        self.perf = PerfTracker(self.args.perf_store,
+                                window=int(self.args.perf_window),
+                                sigma=float(self.args.perf_sigma),
+                                min_change=float(self.args.perf_min_change))
+        self.scheduler = None
+        self.test_params = None
+        if self.args.virsh_record:
+            install_command_backend(CommandRecorder(self.args.virsh_record))
+        elif self.args.virsh_replay:
+            install_command_backend(CommandReplayer(
+                self.args.virsh_replay, float(self.args.replay_speed)))
+        elif self.args.synthetic_host:
+            install_command_backend(
+                SyntheticHost.from_spec(self.args.synthetic_host))
+        # Replayed and synthetic commands have no processes to account.
+        self.cgroups = CgroupAccounting(
+            enabled=not (self.args.no_cgroup or self.args.virsh_replay or
+                         self.args.synthetic_host))
+        self.log_store = LogStore(self.args.log_dir,
+                                  int(self.args.log_excerpt))
+        self.artifacts = None
+        if self.args.artifact_dir:
+            self.artifacts = ArtifactCollector(
+                self.args.artifact_dir, int(self.args.artifact_budget))
+        self.profiler = Profiler(enabled=bool(self.args.profile))
+        self.profiler.install()
+        self.events = EventStream(self.args.events)
         report = Report(self.args.fail_diff)
+        self.report_writer = ReportWriter(report, self.args.report,
+                                          self.profiler)
         try:
-            self.prepare_repos()
+            with self.profiler.phase('prepare_repos'):
+                self.prepare_repos()
             if self.args.pre_cmd:
                 print 'Running command line "%s" before test.' % self.args.pre_cmd
                 res = utils.run(self.args.pre_cmd, ignore_status=True)
                 print 'Result:'
                 for line in str(res).splitlines():
                     print line
-            # service must put at first, or the result will be wrong.
-            self.states = [FileState(), ServiceState(), DirState(),
-                           DomainState(), NetworkState(), PoolState(),
-                           SecretState(), MountState()]
+            self.create_workers()
+            self.pre_test_checks = PreTestChecks()
+            self.pre_test_checks.register(
+                'nvram', self.fix_nvram,
+                ['/var/lib/libvirt/qemu/nvram/virt-tests-vm1_VARS.fd'])
             tests = self.prepare_tests()
 
             if self.args.list:
@@ -1379,28 +5717,59 @@ class LibvirtCI():
                     print short_name
                 exit(0)
 
-            self.prepare_env()
-            for state in self.states:
-                state.backup()
-
+            with self.profiler.phase('prepare_env'):
+                self.prepare_env()
+            with self.profiler.phase('prepare_workers'):
+                self.prepare_workers()
+            self.backup_states()
+
+            if (self.args.order_tests or len(self.workers) > 1 or
+                    int(self.args.warm_guests)):
+                self.get_test_params(tests)
+            if self.args.order_tests:
+                tests = self.order_tests(tests)
+
+            if len(self.workers) > 1:
+                max_load = self.args.max_load or None
+                self.scheduler = Scheduler(
+                    self.history, self.get_test_params(tests),
+                    min_free_mem=int(self.args.min_free_mem),
+                    max_load=max_load,
+                    max_iowait=self.args.max_iowait)
+
+            self.events.emit('run_started', total=len(tests),
+                             workers=[w.name for w in self.workers])
+            test_queue = Queue.Queue()
             for idx, test in enumerate(tests):
-                short_name = test.split('.', 2)[2]
-                print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
-                                          len(tests), short_name),
-                sys.stdout.flush()
-
-                self.prepare_test(test)
-
-                status, res, err_msg = self.run_test(
-                    test,
-                    check=not self.args.no_check,
-                    recover=not self.args.no_recover)
-
-                class_name, test_name = self.split_name(test)
-
-                report.update(test_name, class_name, status,
-                              res.stderr, err_msg, res.duration)
-                report.save(self.args.report)
+                test_queue.put((idx, test))
+            if len(self.workers) == 1:
+                self.run_worker(self.workers[0], test_queue, len(tests),
+                                report)
+            else:
+                threads = []
+                for worker in self.workers:
+                    thread = threading.Thread(
+                        target=self.run_worker,
+                        args=(worker, test_queue, len(tests), report))
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+
+            self.report_writer.submit(self.report_performance)
+
+            planner = RecoveryPlanner()
+            host_diffs = []
+            for state in self.host_states:
+                host_diffs += state.check(recover=not self.args.no_recover,
+                                          planner=planner)
+            for state, failures in planner.run().items():
+                for line in failures:
+                    host_diffs.append('%s %s' % (state.name, line))
+            for line in host_diffs:
+                print '   DIFF|%s' % line
+            if host_diffs:
+                self.report_writer.submit(self.report_host_diffs, host_diffs)
             if self.args.post_cmd:
                 print 'Running command line "%s" after test.' % self.args.post_cmd
                 res = utils.run(self.args.post_cmd, ignore_status=True)
@@ -1410,14 +5779,34 @@ class LibvirtCI():
         except Exception:
             traceback.print_exc()
         finally:
+            for state in self.host_states + [
+                    state for worker in self.workers
+                    for state in worker.states]:
+                state.cleanup()
+            if self.artifacts is not None:
+                self.artifacts.close()
+            for worker in self.workers:
+                if worker.warm_pool is not None:
+                    worker.warm_pool.cleanup()
+                if worker.instance is not None:
+                    worker.instance.cleanup()
+            self.cgroups.cleanup()
             if not self.args.no_restore_pull:
                 self.restore_repos()
-            report.save(self.args.report)
+            self.report_writer.close()
+            self.events.emit('run_finished')
+            self.events.close()
+            if self.args.profile:
+                self.profiler.save(self.args.profile)
+                for line in self.profiler.summary():
+                    print line
 
 
 def state_test():
     states = [FileState(), ServiceState(), DirState(), DomainState(),
-              NetworkState(), PoolState(), SecretState(), MountState()]
+              NetworkState(), PoolState(), SecretState(), MountState(),
+              LinkState(), LoopState(), DeviceMapperState(), FirewallState(),
+              ModuleState()]
     for state in states:
         state.backup()
     utils.run('echo hello > /etc/exports')